@@ -9,13 +9,17 @@ Usage:
     export ANTHROPIC_API_KEY=your_key
     python3 agent_loop.py "Safari" "Navigate to google.com and search for 'Claude AI'"
     python3 agent_loop.py "Finder" "Create a new folder called 'Test' on the Desktop"
+    python3 agent_loop.py Safari "..." --cascade   # route routine turns to a cheaper model
+    python3 agent_loop.py Safari "..." --resume    # continue a session that crashed
+    python3 agent_loop.py --demo-history           # history size with/without delta compaction
 """
 
 import subprocess
 import json
 import sys
 import os
-from typing import Optional
+import time
+from typing import Optional, Union
 
 try:
     import anthropic
@@ -23,6 +27,10 @@ except ImportError:
     print("Install anthropic: pip install anthropic")
     sys.exit(1)
 
+from ui_codec import encode_result, encode_elements
+from element_retriever import NavigationContext
+from session_checkpoint import SessionCheckpoint
+
 
 # Compact tool definitions - descriptions kept minimal
 TOOLS = [
@@ -44,30 +52,44 @@ TOOLS = [
 
 
 class AppAgentBridge:
-    """Bridges Python to the Swift AppAgent via JSON-RPC over stdin/stdout."""
+    """
+    Bridges Python to the Swift AppAgent via JSON-RPC over stdin/stdout.
+
+    The agent process is supervised: if it dies, call() restarts it (up to
+    max_restarts times) and re-observes the UI so the caller gets fresh
+    element ids instead of a dead session.
+    """
 
-    def __init__(self, app_name: str):
+    def __init__(self, app_name: str, command: Optional[list] = None, max_restarts: int = 3):
         self.app_name = app_name
+        self.command = command  # Defaults to the compiled AppAgent
+        self.max_restarts = max_restarts
+        self.restarts = 0
         self.process: Optional[subprocess.Popen] = None
 
     def start(self):
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        agent_path = os.path.join(script_dir, "AppAgent.swift")
-
-        # Pre-compile to avoid timeout on first call
-        print("[Bridge] Compiling Swift agent (this may take a moment)...")
-        compile_result = subprocess.run(
-            ["swiftc", "-o", "/tmp/AppAgent", agent_path],
-            capture_output=True,
-            text=True
-        )
-        if compile_result.returncode != 0:
-            print(f"[Bridge] Compilation failed:\n{compile_result.stderr}")
-            raise RuntimeError("Failed to compile AppAgent.swift")
+        if self.command is None:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            agent_path = os.path.join(script_dir, "AppAgent.swift")
+
+            # Pre-compile to avoid timeout on first call
+            print("[Bridge] Compiling Swift agent (this may take a moment)...")
+            compile_result = subprocess.run(
+                ["swiftc", "-o", "/tmp/AppAgent", agent_path],
+                capture_output=True,
+                text=True
+            )
+            if compile_result.returncode != 0:
+                print(f"[Bridge] Compilation failed:\n{compile_result.stderr}")
+                raise RuntimeError("Failed to compile AppAgent.swift")
+            self.command = ["/tmp/AppAgent", self.app_name, "--json-rpc"]
 
         print("[Bridge] Starting agent...")
+        self._spawn()
+
+    def _spawn(self):
         self.process = subprocess.Popen(
-            ["/tmp/AppAgent", self.app_name, "--json-rpc"],
+            self.command,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -76,20 +98,17 @@ class AppAgentBridge:
         )
 
         # Check if process started successfully
-        import time
         time.sleep(0.1)
         if self.process.poll() is not None:
             stderr = self.process.stderr.read()
             raise RuntimeError(f"Agent failed to start: {stderr}")
 
-    def call(self, tool: str, params: dict = None) -> dict:
-        if not self.process:
-            raise RuntimeError("Agent not started")
-
+    def _send(self, tool: str, params: dict = None) -> tuple:
+        """Returns (result, None), or (None, crash message) if the process died."""
         # Check if process is still alive
         if self.process.poll() is not None:
             stderr = self.process.stderr.read()
-            return {"success": False, "message": f"Agent crashed: {stderr}"}
+            return None, f"Agent crashed: {stderr}"
 
         request = {"tool": tool, "params": params or {}}
         try:
@@ -97,17 +116,54 @@ class AppAgentBridge:
             self.process.stdin.flush()
         except BrokenPipeError:
             stderr = self.process.stderr.read()
-            return {"success": False, "message": f"Agent pipe broken: {stderr}"}
+            return None, f"Agent pipe broken: {stderr}"
 
         response_line = self.process.stdout.readline()
         if not response_line:
             stderr = self.process.stderr.read()
-            return {"success": False, "message": f"No response from agent. stderr: {stderr}"}
+            return None, f"No response from agent. stderr: {stderr}"
 
         try:
-            return json.loads(response_line)
+            return json.loads(response_line), None
         except json.JSONDecodeError:
-            return {"success": False, "message": f"Invalid JSON: {response_line}"}
+            return {"success": False, "message": f"Invalid JSON: {response_line}"}, None
+
+    def _restart(self) -> bool:
+        if self.restarts >= self.max_restarts:
+            return False
+        self.restarts += 1
+        print(f"[Bridge] Restarting agent ({self.restarts}/{self.max_restarts})...")
+        if self.process.poll() is None:
+            self.process.kill()  # Hung rather than dead
+            self.process.wait()
+        try:
+            self._spawn()
+        except RuntimeError as e:
+            print(f"[Bridge] {e}")
+            return False
+        return True
+
+    def call(self, tool: str, params: dict = None) -> dict:
+        if not self.process:
+            raise RuntimeError("Agent not started")
+
+        result, crash = self._send(tool, params)
+        if crash is None:
+            return result
+        if not self._restart():
+            return {"success": False, "message": crash}
+
+        # Observing is safe to retry; anything else may or may not have happened
+        # before the crash, so report failure along with a fresh snapshot
+        observed, _ = self._send("observe_ui")
+        if tool == "observe_ui" and observed:
+            return observed
+        return {
+            "success": False,
+            "message": f"{crash.strip()} Agent restarted; '{tool}' may not have run and element IDs "
+                       "were reset. Current UI attached.",
+            "data": observed.get("data") if observed else None,
+        }
 
     def stop(self):
         if self.process:
@@ -137,11 +193,166 @@ def _prune_messages(messages: list, max_chars: int = 20000) -> list:
     return messages
 
 
-def run_agent(app_name: str, task: str, max_turns: int = 30, verbose: bool = True):
-    """Run the agent loop until task completion or max turns."""
-
-    client = anthropic.Anthropic()
-    bridge = AppAgentBridge(app_name)
+class ObservationHistory:
+    """
+    Keeps only the newest observe_ui result in full.
+
+    When a new snapshot arrives, each older observe_ui tool_result is rewritten
+    in place (same tool_use_id, so the tool_use/tool_result pairing stays valid)
+    as a delta against the new snapshot, or as a one-line stub if the delta
+    would be too long. diff_ui results are already deltas and are left alone.
+    """
+
+    def __init__(self, max_delta_lines: int = 12):
+        self.max_delta_lines = max_delta_lines
+        self.latest: Optional[tuple] = None  # (tool_use_id, turn, elements)
+
+    def record(self, messages: list, tool_use_id: Optional[str], turn: Union[int, str], result: dict):
+        """`turn` labels the observation in stubs; the resume snapshot passes "N (resume)"."""
+        data = result.get("data")
+        if not (result.get("success") and isinstance(data, dict) and "elements" in data):
+            return
+        elements = data["elements"]
+        if self.latest:
+            old_id, old_turn, old_elements = self.latest
+            _replace_tool_result(messages, old_id, self._delta(old_turn, old_elements, turn, elements))
+        self.latest = (tool_use_id, turn, elements)
+
+    def _delta(self, old_turn: Union[int, str], old: list, turn: Union[int, str], new: list) -> str:
+        # AppAgent ids are depth-first positions, so one insertion renumbers every
+        # later element; match on what the element is instead
+        def identity(e):
+            return (e.get("path"), e.get("role"), e.get("title"))
+
+        def content(e):
+            return (e.get("subrole"), e.get("value"), e.get("enabled", True), tuple(e.get("actions") or ()))
+
+        unmatched: dict = {}
+        for e in new:
+            unmatched.setdefault(identity(e), []).append(e)
+        differs = []
+        for e in old:
+            candidates = unmatched.get(identity(e))
+            if not candidates:
+                differs.append(e)  # Gone since
+            elif content(candidates.pop(0)) != content(e):
+                differs.append(e)  # Changed since
+        added = sum(len(v) for v in unmatched.values())
+
+        header = f"[observe_ui from turn {old_turn}, superseded by turn {turn}]"
+        if not differs and not added:
+            return f"{header} identical to turn {turn}"
+        counts = f"{len(differs)} element(s) differed then, {added} new since"
+        if len(differs) > self.max_delta_lines:
+            return f"{header} {counts}"
+        return "\n".join([f"{header} {counts}; at turn {old_turn} these were:"] + encode_elements(differs))
+
+
+def _replace_tool_result(messages: list, tool_use_id: str, content: str) -> bool:
+    """Swap the content of a tool_result block, keeping its tool_use_id."""
+    for message in reversed(messages):
+        if message["role"] != "user" or not isinstance(message["content"], list):
+            continue
+        for block in message["content"]:
+            if isinstance(block, dict) and block.get("type") == "tool_result" \
+                    and block.get("tool_use_id") == tool_use_id:
+                block["content"] = content
+                return True
+    return False
+
+
+def _landmark_type(element: dict) -> Optional[str]:
+    """Port of AppAgent.detectLandmarkType."""
+    role = element.get("role", "").lower()
+    title = (element.get("title") or "").lower()
+    path = element.get("path", "")
+
+    if "toolbar" in role:
+        return "toolbar"
+    if "sidebar" in role or "sidebar" in title:
+        return "sidebar"
+    if "navigation" in role or "navbar" in role:
+        return "navigation"
+    if "search" in role or "search" in title:
+        return "search"
+    if "main" in role or "content" in role:
+        return "main"
+    if role == "axsplitgroup":
+        return "split-view"
+    if role == "axtabgroup":
+        return "tabs"
+    if role in ("axoutline", "axtable"):
+        return "list"
+    if role == "axscrollarea" and "AXWindow" in path and "AXSheet" not in path and element.get("title") is not None:
+        return "main"
+    if "form" in title or "login" in title or "sign" in title:
+        return "form"
+    return None
+
+
+def _update_context(context: NavigationContext, tool_name: str, tool_input: dict, result: dict):
+    """
+    Mirror AppAgent's navigation scratch pad on the Python side for checkpoints.
+
+    where_am_i returns the context only as text, so location and landmarks are
+    derived from observe_ui snapshots the way AppAgent derives them.
+    """
+    context.recent_actions.append(f"{tool_name}({json.dumps(tool_input)})")
+    del context.recent_actions[:-20]  # Same window as AppAgent's working memory
+
+    data = result.get("data")
+    if tool_name == "observe_ui" and isinstance(data, dict) and "elements" in data:
+        # Same derivations AppAgent makes in find_landmarks and updatePath
+        elements = data["elements"]
+        context.landmarks = [
+            f"{_landmark_type(e)}: {e.get('title') or e.get('role')}" for e in elements if _landmark_type(e)
+        ]
+        focused = next((e for e in elements if e.get("id") == data.get("focusedElement")), None)
+        if focused:
+            context.current_path = [s.strip() for s in focused.get("path", "").split(">")]
+    elif tool_name == "set_hypothesis":
+        context.hypothesis = tool_input.get("hypothesis")
+
+
+def _discard_checkpoint(checkpoint_path: Optional[str]):
+    """A finished task has nothing to resume."""
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def _attach_usage(result: dict, router) -> dict:
+    """Add the router's per-model usage report to a run result."""
+    if router:
+        result["usage"] = router.report()
+    return result
+
+
+def run_agent(
+    app_name: str,
+    task: str,
+    max_turns: int = 30,
+    verbose: bool = True,
+    client=None,
+    bridge=None,
+    router=None,
+    compact_history: bool = True,
+    checkpoint_path: Optional[str] = None,
+    resume: bool = False,
+):
+    """
+    Run the agent loop until task completion or max turns.
+
+    `client` and `bridge` default to the Anthropic API and the Swift AppAgent.
+    Pass a `model_router.ModelRouter` as `router` to send routine turns to a
+    cheaper model; without one every turn uses the default model.
+    With `compact_history`, superseded observe_ui results are rewritten as
+    deltas so the history holds a single full view of the UI.
+    With `checkpoint_path`, the session is saved after every turn; `resume`
+    continues from that checkpoint instead of starting over.
+    """
+
+    client = client or anthropic.Anthropic()
+    bridge = bridge or AppAgentBridge(app_name)
 
     if verbose:
         print(f"[Agent] Starting agent for '{app_name}'")
@@ -153,25 +364,66 @@ def run_agent(app_name: str, task: str, max_turns: int = 30, verbose: bool = Tru
     system_prompt = f"""Control "{app_name}" via accessibility API. Task: {task}
 
 Workflow: observe_ui → act → diff_ui → repeat → task_complete/task_failed
-Element IDs (e.g. "e5") change between observations. Use press_key for shortcuts (cmd+t=new tab)."""
+Element IDs (e.g. "e5") change between observations. Use press_key for shortcuts (cmd+t=new tab).
+UI results list one element per line, indented by tree depth: id role[/subrole] "title" ="value" ! (disabled) [actions: p=press m=menu c=confirm]."""
 
     messages = [{"role": "user", "content": f"Please complete this task: {task}"}]
+    history = ObservationHistory() if compact_history else None
+    context = NavigationContext()
+    snapshot_hash = None
+    start_turn = 0
+
+    checkpoint = SessionCheckpoint.load(checkpoint_path) if resume and checkpoint_path else None
+    if checkpoint and (checkpoint.app_name, checkpoint.task) == (app_name, task):
+        messages, context = checkpoint.messages, checkpoint.context
+        snapshot_hash, start_turn = checkpoint.snapshot_hash, checkpoint.turn
+        if history and checkpoint.latest_observation:
+            history.latest = tuple(checkpoint.latest_observation)
+
+        # The UI may have moved on and element IDs are stale; re-observe first.
+        # The snapshot goes in as an observe_ui call of its own so that
+        # ObservationHistory can supersede it like any other observation.
+        result = bridge.call("observe_ui")
+        resume_id = f"toolu_resume_{start_turn}"
+        _update_context(context, "observe_ui", {}, result)
+        if isinstance(result.get("data"), dict):
+            snapshot_hash = result["data"].get("hash", snapshot_hash)
+        messages.append({"role": "assistant", "content": [
+            {"type": "tool_use", "id": resume_id, "name": "observe_ui", "input": {}}]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": resume_id, "content": encode_result(result, max_chars=2000)},
+            {"type": "text", "text": f"[Session resumed after a crash at turn {start_turn}. "
+                                     f"Element IDs from before this observation are stale.]"}]})
+        if history:
+            # Turn start_turn may have observed too; don't give both the same label
+            history.record(messages, resume_id, f"{start_turn} (resume)", result)
+        if verbose:
+            print(f"[Agent] Resumed from checkpoint at turn {start_turn}")
 
-    for turn in range(max_turns):
+    for turn in range(start_turn, max_turns):
         if verbose:
             print(f"\n[Turn {turn + 1}/{max_turns}]")
 
+        tier = router.select() if router else None
+        model = tier.model if tier else "claude-sonnet-4-20250514"
+        if verbose and router:
+            print(f"[Router] {model} ({router.decisions[-1].reason})")
+
+        started = time.monotonic()
         response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4096,
+            model=model,
+            max_tokens=tier.max_tokens if tier else 4096,
             system=system_prompt,
             tools=TOOLS,
             messages=messages
         )
+        if router:
+            router.record_usage(tier, response, time.monotonic() - started)
 
         # Process response
         assistant_content = []
         tool_results = []
+        observations = []
 
         for block in response.content:
             if block.type == "text":
@@ -191,27 +443,44 @@ Element IDs (e.g. "e5") change between observations. Use press_key for shortcuts
                     if verbose:
                         print(f"\n[Agent] Task completed: {tool_input.get('summary', 'Done')}")
                     bridge.stop()
-                    return {"success": True, "summary": tool_input.get("summary")}
+                    _discard_checkpoint(checkpoint_path)
+                    return _attach_usage({"success": True, "summary": tool_input.get("summary")}, router)
+
+                if tool_name == "task_failed" and router and router.should_confirm_failure(tier):
+                    # Don't give up on the cheap model's word; let the strong model re-check
+                    if verbose:
+                        print("[Router] task_failed from fast model, escalating to confirm")
+                    assistant_content.append(block)
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": block.id,
+                        "content": "Not accepted yet. Re-check the UI before giving up.",
+                    })
+                    continue
 
                 if tool_name == "task_failed":
                     if verbose:
                         print(f"\n[Agent] Task failed: {tool_input.get('reason', 'Unknown')}")
                     bridge.stop()
-                    return {"success": False, "reason": tool_input.get("reason")}
+                    _discard_checkpoint(checkpoint_path)
+                    return _attach_usage({"success": False, "reason": tool_input.get("reason")}, router)
 
                 # Execute tool via bridge
                 result = bridge.call(tool_name, tool_input)
+                if router:
+                    router.observe_tool(tool_name, result)
+
+                # Compact encoding for snapshots/diffs (truncated at line boundaries
+                # so every element id shown stays intact); other results stay JSON
+                result_str = encode_result(result, max_chars=2000)
+                if len(result_str) > 2000 and result_str.startswith("{"):
+                    result_str = result_str[:2000] + '..."}'
 
-                # Truncate result for both display AND message history to save tokens
-                result_str = json.dumps(result)
-                if len(result_str) > 2000:
-                    # Keep structure but truncate data arrays
-                    if isinstance(result.get("data"), dict) and "elements" in result.get("data", {}):
-                        result["data"]["elements"] = result["data"]["elements"][:15]
-                        result["data"]["_truncated"] = True
-                    result_str = json.dumps(result)
-                    if len(result_str) > 2000:
-                        result_str = result_str[:2000] + '..."}'
+                _update_context(context, tool_name, tool_input, result)
+                if tool_name == "observe_ui":
+                    observations.append((block.id, result))
+                    if isinstance(result.get("data"), dict):
+                        snapshot_hash = result["data"].get("hash", snapshot_hash)
 
                 if verbose:
                     display_str = result_str[:500] + "..." if len(result_str) > 500 else result_str
@@ -228,10 +497,19 @@ Element IDs (e.g. "e5") change between observations. Use press_key for shortcuts
         messages.append({"role": "assistant", "content": assistant_content})
         if tool_results:
             messages.append({"role": "user", "content": tool_results})
+        if history:
+            for tool_use_id, result in observations:
+                history.record(messages, tool_use_id, turn + 1, result)
 
         # Prune old messages to stay under token limits
         messages = _prune_messages(messages)
 
+        if checkpoint_path:
+            SessionCheckpoint(
+                app_name, task, turn + 1, messages, context, snapshot_hash,
+                list(history.latest) if history and history.latest else None,
+            ).save(checkpoint_path)
+
         # Check stop reason
         if response.stop_reason == "end_turn" and not tool_results:
             if verbose:
@@ -239,10 +517,59 @@ Element IDs (e.g. "e5") change between observations. Use press_key for shortcuts
             break
 
     bridge.stop()
-    return {"success": False, "reason": "Max turns reached"}
+    return _attach_usage({"success": False, "reason": "Max turns reached"}, router)
+
+
+def history_demo(observations: int = 6):
+    """
+    Scripted run comparing history size with and without ObservationHistory.
+
+    Each snapshot inserts one more toolbar button near the top of the tree, so
+    every later AppAgent id shifts, and changes the address bar value.
+    """
+    import copy
+    from model_router import MockClient, ScriptedBridge
+    from ui_codec import sample_snapshot
+
+    base = sample_snapshot()
+    results = []
+    for i in range(observations):
+        snapshot = copy.deepcopy(base)
+        toolbar = snapshot["elements"][5]["path"]
+        extra = [{"id": "", "role": "AXButton", "subrole": None, "title": f"Extension {n}", "value": None,
+                  "actions": ["AXPress"], "enabled": True, "path": f"{toolbar} > AXButton"} for n in range(i)]
+        snapshot["elements"][10:10] = extra
+        for n, element in enumerate(snapshot["elements"]):
+            element["id"] = f"e{n}"
+        snapshot["elements"][10 + i]["value"] = f"https://www.google.com/search?q=page{i}"
+        results.append({"success": True, "message": f"Observed {len(snapshot['elements'])} elements",
+                        "data": snapshot})
+
+    script = [("observe_ui", {}), ("click", {"element_id": "e6"})] * observations
+    script.append(("task_complete", {"summary": "done"}))
+
+    class RecordingClient(MockClient):
+        def create(self, **kwargs):
+            self.last_messages = kwargs["messages"]
+            return super().create(**kwargs)
+
+    for compact in (False, True):
+        client = RecordingClient(script, {})
+        run_agent("Safari", "demo", verbose=False, client=client,
+                  bridge=ScriptedBridge({"observe_ui": results}), compact_history=compact)
+        size = sum(_estimate_msg_size(m) for m in client.last_messages)
+        print(f"compact_history={compact}: {size} chars of history at the final turn")
+
+    stubs = [b["content"] for m in client.last_messages if m["role"] == "user" and isinstance(m["content"], list)
+             for b in m["content"] if str(b.get("content", "")).startswith("[observe_ui")]
+    print(f"\n{stubs[-1]}")
 
 
 def main():
+    if "--demo-history" in sys.argv:
+        history_demo()
+        return
+
     if len(sys.argv) < 3:
         print(__doc__)
         print("\nExamples:")
@@ -255,17 +582,29 @@ def main():
     task = sys.argv[2]
     verbose = "--quiet" not in sys.argv
 
+    router = None
+    if "--cascade" in sys.argv:
+        from model_router import ModelRouter
+        router = ModelRouter()
+
     if not os.environ.get("ANTHROPIC_API_KEY"):
         print("Error: ANTHROPIC_API_KEY environment variable not set")
         sys.exit(1)
 
-    result = run_agent(app_name, task, verbose=verbose)
+    # Always checkpoint; --resume picks up a session that died mid-task
+    checkpoint_path = f"/tmp/agent_loop_{app_name.replace(' ', '_')}.json"
+    result = run_agent(app_name, task, verbose=verbose, router=router,
+                       checkpoint_path=checkpoint_path, resume="--resume" in sys.argv)
 
     print("\n" + "=" * 60)
     if result.get("success"):
         print(f"SUCCESS: {result.get('summary')}")
     else:
         print(f"FAILED: {result.get('reason')}")
+    if result.get("usage"):
+        for model, usage in result["usage"]["models"].items():
+            print(f"  {model}: {usage['calls']} calls, "
+                  f"{usage['input_tokens']}+{usage['output_tokens']} tokens, ${usage['cost_usd']:.4f}")
 
 
 if __name__ == "__main__":
@@ -42,6 +42,7 @@ For training:
 """
 
 import json
+import socket
 from dataclasses import dataclass, field
 from typing import List, Dict, Optional, Tuple
 from pathlib import Path
@@ -108,6 +109,153 @@ class NavigationContext:
         return "\n".join(parts)
 
 
+# =============================================================================
+# HIERARCHY INDEX
+# =============================================================================
+
+# Only sheets are detectable from a snapshot: a dialog is an AXWindow with
+# subrole AXDialog, and UIElement carries no subrole
+MODAL_ROLES = ("AXSheet",)
+
+
+def _split_path(path: str) -> Tuple[str, ...]:
+    return tuple(p.strip() for p in path.split(">") if p.strip())
+
+
+@dataclass
+class PathNode:
+    """One node of the path trie: an element (or a placeholder for a missing ancestor)."""
+    segments: Tuple[str, ...]
+    element: Optional[UIElement] = None
+    parent: Optional["PathNode"] = None
+    children: List["PathNode"] = field(default_factory=list)
+    start: int = 0  # Preorder interval: descendants are order[start + 1:end]
+    end: int = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.segments)
+
+    @property
+    def path(self) -> str:
+        return " > ".join(self.segments)
+
+
+class PathTrie:
+    """
+    Trie over UIElement.path, built from a snapshot's elements.
+
+    AppAgent paths are role chains ("AXApplication > AXWindow > AXGroup"), so two
+    sibling groups have identical paths. Elements arrive in depth-first order,
+    though, so each element becomes its own node under the nearest preceding
+    element whose path is its parent path; siblings stay distinct. Ancestors
+    missing from the input (e.g. a pre-filtered element list) get placeholder
+    nodes.
+
+    Lookups:
+    - node(id), nodes_at(path), nodes_with_role(role): O(1) dict hits
+    - ancestors(id): O(depth) via parent pointers
+    - is_descendant(a, b): O(1) via preorder intervals
+    - subtree(id or path): O(depth) to locate + O(size of result)
+    """
+
+    def __init__(self, elements: List[UIElement]):
+        self.root = PathNode(segments=())
+        self._order: List[PathNode] = []
+        self._by_id: Dict[str, PathNode] = {}
+        self._by_path: Dict[Tuple[str, ...], List[PathNode]] = {}
+        self._by_role: Dict[str, List[PathNode]] = {}
+
+        stack = [self.root]
+        for element in elements:
+            segments = _split_path(element.path) if element.path else (element.role,)
+            parent_segments = segments[:-1]
+
+            # Unwind to the deepest open node that is a prefix of this path
+            while len(stack) > 1 and stack[-1].segments != parent_segments[:stack[-1].depth]:
+                stack.pop()
+            # Add placeholders for ancestors we never saw
+            for segment in parent_segments[stack[-1].depth:]:
+                stack.append(self._add(stack[-1], segment, None))
+            stack.append(self._add(stack[-1], segments[-1], element))
+
+        self._number(self.root)
+
+    def _add(self, parent: PathNode, segment: str, element: Optional[UIElement]) -> PathNode:
+        node = PathNode(segments=parent.segments + (segment,), element=element, parent=parent)
+        parent.children.append(node)
+        self._by_path.setdefault(node.segments, []).append(node)
+        self._by_role.setdefault(segment, []).append(node)
+        if element:
+            self._by_id[element.id] = node
+        return node
+
+    def _number(self, root: PathNode):
+        # Iterative preorder (deep trees would hit the recursion limit)
+        stack = [(root, False)]
+        while stack:
+            node, done = stack.pop()
+            if done:
+                node.end = len(self._order)
+                continue
+            node.start = len(self._order)
+            self._order.append(node)
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def node(self, element_id: str) -> Optional[PathNode]:
+        return self._by_id.get(element_id)
+
+    def nodes_at(self, path: str) -> List[PathNode]:
+        return self._by_path.get(_split_path(path), [])
+
+    def nodes_with_role(self, role: str) -> List[PathNode]:
+        return self._by_role.get(role, [])
+
+    def ancestors(self, element_id: str) -> List[UIElement]:
+        """Nearest first."""
+        node = self._by_id.get(element_id)
+        result = []
+        while node and node.parent:
+            node = node.parent
+            if node.element:
+                result.append(node.element)
+        return result
+
+    def is_descendant(self, element_id: str, ancestor_id: str) -> bool:
+        node, anc = self._by_id.get(element_id), self._by_id.get(ancestor_id)
+        if not node or not anc:
+            return False
+        return anc.start < node.start < anc.end
+
+    def subtree(self, scope: str, include_root: bool = True) -> List[UIElement]:
+        """Elements under an element id or under every node at a path."""
+        roots = [self._by_id[scope]] if scope in self._by_id else self.nodes_at(scope)
+        result = []
+        for root in roots:
+            result.extend(self.node_subtree(root, include_root))
+        return result
+
+    def node_subtree(self, node: PathNode, include_root: bool = True) -> List[UIElement]:
+        first = node.start if include_root else node.start + 1
+        return [n.element for n in self._order[first:node.end] if n.element]
+
+    def modals(self) -> List[PathNode]:
+        """Open sheets in tree order."""
+        return sorted((n for role in MODAL_ROLES for n in self.nodes_with_role(role)), key=lambda n: n.start)
+
+    def window_of(self, node: PathNode) -> Optional[PathNode]:
+        """Nearest enclosing AXWindow node (possibly a placeholder)."""
+        while node.parent:
+            node = node.parent
+            if node.segments[-1] == "AXWindow":
+                return node
+        return None
+
+
 class ElementRetriever:
     """
     Wolpertinger-style retriever for UI elements.
@@ -115,26 +263,52 @@ class ElementRetriever:
     Embeds task + context → finds k-nearest elements → returns filtered action space.
     """
 
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", server_socket: Optional[str] = None):
+        """
+        With `server_socket`, encoding goes through a shared embedding_server
+        instead of loading the model in this process. If no server is listening
+        there (or it serves another model), the model is loaded locally.
+        """
+        self.model_name = model_name
+        self.client = None
+        if server_socket:
+            from embedding_server import EmbeddingClient
+            self.client = EmbeddingClient.connect(server_socket, model_name)
+
+        if self.client:
+            self.encoder = None
+            self.embed_dim = self.client.dim
+        else:
+            self._load_encoder()
+
+        # Cache for element embeddings (reuse across calls)
+        self._element_cache: Dict[str, np.ndarray] = {}
+
+    def _load_encoder(self):
         if HAS_SENTENCE_TRANSFORMERS:
-            self.encoder = SentenceTransformer(model_name)
+            self.encoder = SentenceTransformer(self.model_name)
             self.embed_dim = self.encoder.get_sentence_embedding_dimension()
         else:
             self.encoder = None
             self.embed_dim = 384  # Fake dimension
 
-        # Cache for element embeddings (reuse across calls)
-        self._element_cache: Dict[str, np.ndarray] = {}
-
-    def _encode(self, texts: List[str]) -> np.ndarray:
+    def _encode(self, texts: List[str]) -> "np.ndarray":
         """Encode texts to embeddings."""
+        if self.client:
+            try:
+                return self.client.encode(texts)
+            except (OSError, ConnectionError, RuntimeError, socket.timeout):
+                # Server went away or hung; encode in-process from now on
+                self.client.close()
+                self.client = None
+                self._load_encoder()
         if self.encoder:
             return self.encoder.encode(texts, convert_to_numpy=True)
         else:
             # Random embeddings for testing without sentence-transformers
             return np.random.randn(len(texts), self.embed_dim).astype(np.float32)
 
-    def embed_element(self, element: UIElement) -> np.ndarray:
+    def embed_element(self, element: UIElement) -> "np.ndarray":
         """
         Embed a UI element.
 
@@ -157,7 +331,7 @@ class ElementRetriever:
         self._element_cache[cache_key] = embedding
         return embedding
 
-    def embed_task(self, task: str, context: Optional[NavigationContext] = None) -> np.ndarray:
+    def embed_task(self, task: str, context: Optional[NavigationContext] = None) -> "np.ndarray":
         """
         Embed the task + navigation context.
 
@@ -180,16 +354,32 @@ class ElementRetriever:
         elements: List[UIElement],
         context: Optional[NavigationContext] = None,
         k: int = 20,
-        actionable_only: bool = True
+        actionable_only: bool = True,
+        scope: Optional[str] = "auto",
+        restrict: bool = True,
+        scope_boost: float = 0.15,
+        trie: Optional[PathTrie] = None
     ) -> List[Tuple[UIElement, float]]:
         """
         Retrieve top-k elements most relevant to the task.
 
+        `scope` narrows the search to a subtree: an element id, a path, or
+        "auto" (with a sheet open, everything but the rest of its window;
+        else boost the subtree at context.current_path). With `restrict`, only in-scope elements are
+        scored; otherwise in-scope scores get `scope_boost`. Pass a prebuilt
+        `trie` to reuse it across queries on the same snapshot.
+
         Returns: List of (element, score) tuples, sorted by relevance.
         """
+        in_scope, restrict = self._resolve_scope(elements, context, scope, restrict, trie)
+
         if actionable_only:
             elements = [e for e in elements if e.is_actionable]
 
+        if in_scope is not None and restrict:
+            scoped = [e for e in elements if e.id in in_scope]
+            elements = scoped or elements  # An empty scope shouldn't hide everything
+
         if len(elements) <= k:
             # No need to filter, return all with dummy scores
             return [(e, 1.0) for e in elements]
@@ -205,11 +395,46 @@ class ElementRetriever:
         element_norms = element_embs / (np.linalg.norm(element_embs, axis=1, keepdims=True) + 1e-8)
         scores = element_norms @ task_norm
 
+        if in_scope is not None and not restrict:
+            scores = scores + scope_boost * np.array([e.id in in_scope for e in elements])
+
         # Get top-k indices
         top_k_idx = np.argsort(scores)[-k:][::-1]
 
         return [(elements[i], float(scores[i])) for i in top_k_idx]
 
+    def _resolve_scope(
+        self,
+        elements: List[UIElement],
+        context: Optional[NavigationContext],
+        scope: Optional[str],
+        restrict: bool,
+        trie: Optional[PathTrie]
+    ) -> Tuple[Optional[set], bool]:
+        """Ids of in-scope elements (None = no scoping) and whether to restrict to them."""
+        if not scope or not any(e.path for e in elements):
+            return None, restrict
+        trie = trie or PathTrie(elements)
+
+        if scope != "auto":
+            return {e.id for e in trie.subtree(scope)}, restrict
+
+        sheets = trie.modals()
+        if sheets:
+            # A sheet blocks the rest of its own window; other windows and the
+            # menu bar stay usable
+            blocked = set()
+            for sheet in sheets:
+                window = trie.window_of(sheet)
+                if window:
+                    blocked |= {e.id for e in trie.node_subtree(window)} - {e.id for e in trie.node_subtree(sheet)}
+            return {e.id for e in elements} - blocked, restrict
+        if context and context.current_path:
+            ids = {e.id for e in trie.subtree(" > ".join(context.current_path))}
+            if ids:
+                return ids, False
+        return None, restrict
+
     def clear_cache(self):
         """Clear element embedding cache (call when UI changes significantly)."""
         self._element_cache.clear()
@@ -310,9 +535,9 @@ class RetrieverTrainer:
 
     def compute_contrastive_loss(
         self,
-        query_emb: np.ndarray,
-        positive_emb: np.ndarray,
-        negative_embs: np.ndarray,
+        query_emb: "np.ndarray",
+        positive_emb: "np.ndarray",
+        negative_embs: "np.ndarray",
         temperature: float = 0.07
     ) -> float:
         """
@@ -539,6 +764,31 @@ def demo():
     for elem, score in results:
         print(f"  [{elem.id}] {elem.role}: {elem.title or elem.value} (score: {score:.3f})")
 
+    # Hierarchy: a dense window with a save sheet open on top, plus the menu bar
+    win = "AXApplication > AXWindow"
+    dense = [UIElement("e0", "AXApplication", path="AXApplication"),
+             UIElement("e1", "AXMenuBar", path="AXApplication > AXMenuBar")]
+    for title in ["File", "Edit", "Window"]:
+        dense.append(UIElement(f"e{len(dense)}", "AXMenuBarItem", title=title,
+                               actions=["AXPress"], path="AXApplication > AXMenuBar > AXMenuBarItem"))
+    dense.append(UIElement(f"e{len(dense)}", "AXWindow", path=win))
+    for i in range(60):
+        dense.append(UIElement(f"e{len(dense)}", "AXButton", title=f"Toolbar item {i}",
+                               actions=["AXPress"], path=f"{win} > AXToolbar > AXButton"))
+    dense.append(UIElement(f"e{len(dense)}", "AXSheet", path=f"{win} > AXSheet"))
+    sheet_id = dense[-1].id
+    for title in ["Save", "Cancel", "Don't Save"]:
+        dense.append(UIElement(f"e{len(dense)}", "AXButton", title=title,
+                               actions=["AXPress"], path=f"{win} > AXSheet > AXButton"))
+
+    trie = PathTrie(dense)
+    save_id = dense[-3].id
+    print(f"\nDense screen: {len(dense)} elements, modal {sheet_id} open")
+    print(f"  ancestors of {save_id}: {[e.id for e in trie.ancestors(save_id)]}")
+    print(f"  {save_id} under sheet: {trie.is_descendant(save_id, sheet_id)}")
+    results = retriever.retrieve("Save the document", dense, k=6)
+    print(f"  auto scope -> sheet and menu bar, toolbar blocked: {[e.title for e, _ in results]}")
+
 
 if __name__ == "__main__":
     demo()
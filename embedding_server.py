@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+embedding_server.py - Shared, micro-batching embedding service for ElementRetriever
+
+Every process that builds an ElementRetriever loads its own SentenceTransformer
+and runs one tiny forward pass per element. With several agents on one host
+that is N copies of the model in RAM and N streams of batch-size-1 inference.
+
+This server owns a single encoder behind a Unix socket:
+
+    agent 1 ─┐                 ┌──────────────┐
+    agent 2 ─┼─ unix socket ──▶│ result cache │──miss──▶ micro-batcher ──▶ encoder
+    agent N ─┘                 └──────────────┘          (≤ max_batch texts,
+                                                          ≤ max_delay_ms wait)
+
+Concurrent requests are merged into one encode() call, waiting at most
+max_delay_ms for a batch to fill. Identical texts in flight share one slot.
+Results go into an LRU cache shared by all clients.
+
+Usage:
+    python3 embedding_server.py serve [--socket /tmp/element_embedder.sock] [--model all-MiniLM-L6-v2]
+    python3 embedding_server.py bench   # throughput and p50/p99 latency vs. client count
+
+    retriever = ElementRetriever(server_socket="/tmp/element_embedder.sock")
+    # Falls back to in-process encoding if the server is missing or dies
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import List, Dict, Optional, Tuple
+
+from element_retriever import np, HAS_NUMPY, HAS_SENTENCE_TRANSFORMERS
+
+if HAS_SENTENCE_TRANSFORMERS:
+    from sentence_transformers import SentenceTransformer
+
+
+DEFAULT_SOCKET = "/tmp/element_embedder.sock"
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+
+
+# =============================================================================
+# WIRE FORMAT
+# =============================================================================
+# Each message: 8-byte header (JSON length, payload length), JSON, raw payload.
+# Embeddings travel as raw float32 bytes, not JSON numbers.
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_message(sock: socket.socket, header: Dict, payload: bytes = b""):
+    body = json.dumps(header).encode()
+    sock.sendall(struct.pack("!II", len(body), len(payload)) + body + payload)
+
+
+def recv_message(sock: socket.socket) -> Tuple[Dict, bytes]:
+    body_len, payload_len = struct.unpack("!II", _recv_exact(sock, 8))
+    header = json.loads(_recv_exact(sock, body_len))
+    payload = _recv_exact(sock, payload_len) if payload_len else b""
+    return header, payload
+
+
+# =============================================================================
+# SERVER
+# =============================================================================
+
+class MicroBatcher:
+    """
+    Collects texts from many threads and encodes them in shared batches.
+
+    A batch is flushed when it reaches max_batch texts or when max_delay_ms
+    has passed since its first text arrived, whichever comes first.
+    """
+
+    def __init__(self, encoder, max_batch: int = 64, max_delay_ms: float = 5.0, cache_size: int = 50000,
+                 timeout: float = 30.0):
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.cache_size = cache_size
+        self.timeout = timeout  # Per request; a wedged encoder turns into an error reply
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._stopped = threading.Event()
+        self.stats = {"requests": 0, "texts": 0, "cache_hits": 0, "batches": 0, "batched_texts": 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        futures = []
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            for text in texts:
+                if text in self._cache:
+                    self._cache.move_to_end(text)
+                    self.stats["cache_hits"] += 1
+                    future = Future()
+                    future.set_result(self._cache[text])
+                elif text in self._pending:
+                    future = self._pending[text]  # Same text already in flight
+                else:
+                    future = self._pending[text] = Future()
+                    self._queue.put(text)
+                futures.append(future)
+        deadline = time.monotonic() + self.timeout
+        try:
+            results = [f.result(timeout=max(deadline - time.monotonic(), 0)) for f in futures]
+        except FutureTimeout:
+            raise TimeoutError(f"encode did not finish within {self.timeout}s")
+        return np.stack(results) if results else np.zeros((0, 0), np.float32)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: List[str]):
+        try:
+            embeddings = np.asarray(self.encoder.encode(batch, convert_to_numpy=True), dtype=np.float32)
+        except Exception as e:
+            with self._lock:
+                futures = [self._pending.pop(t) for t in batch]
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["batched_texts"] += len(batch)
+            futures = []
+            for text, embedding in zip(batch, embeddings):
+                self._cache[text] = embedding
+                futures.append((self._pending.pop(text), embedding))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for future, embedding in futures:
+            future.set_result(embedding)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.server.owner._connections.add(self.request)
+
+    def finish(self):
+        self.server.owner._connections.discard(self.request)
+
+    def handle(self):
+        server: "EmbeddingServer" = self.server.owner
+        while True:
+            try:
+                header, _ = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            if header.get("op") == "info":
+                send_message(self.request, {"model": server.model_name, "dim": server.dim})
+                continue
+            try:
+                embeddings = server.batcher.encode(header.get("texts", []))
+                send_message(self.request, {"n": len(embeddings), "dim": server.dim}, embeddings.tobytes())
+            except Exception as e:
+                send_message(self.request, {"error": str(e)})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64  # Many agents connect at once on startup
+
+
+class EmbeddingServer:
+    """One encoder shared by every ElementRetriever on the host."""
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET,
+        model_name: str = DEFAULT_MODEL,
+        encoder=None,
+        max_batch: int = 64,
+        max_delay_ms: float = 5.0,
+        cache_size: int = 50000,
+        timeout: float = 30.0
+    ):
+        if encoder is None:
+            if not HAS_SENTENCE_TRANSFORMERS:
+                raise RuntimeError("Install sentence-transformers: pip install sentence-transformers")
+            encoder = SentenceTransformer(model_name)
+        self.socket_path = socket_path
+        self.model_name = model_name
+        self.dim = encoder.get_sentence_embedding_dimension()
+        self.batcher = MicroBatcher(encoder, max_batch, max_delay_ms, cache_size, timeout)
+        self._server: Optional[_UnixServer] = None
+        self._connections: set = set()
+
+    def start(self, background: bool = True):
+        if os.path.exists(self.socket_path):
+            live = EmbeddingClient.connect(self.socket_path, timeout=1.0)
+            if live:
+                live.close()
+                raise RuntimeError(f"An embedding server ({live.model_name}) is already serving {self.socket_path}")
+            os.remove(self.socket_path)  # Stale socket from a previous run
+        self._server = _UnixServer(self.socket_path, _Handler)
+        self._server.owner = self
+        if background:
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        else:
+            self._server.serve_forever()
+
+    def stop(self):
+        if not self._server:
+            return  # Never started; the socket (if any) isn't ours
+        self._server.shutdown()
+        self._server.server_close()
+        for conn in list(self._connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)  # Clients see the server go away
+            except OSError:
+                pass
+        self.batcher.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+# =============================================================================
+# CLIENT
+# =============================================================================
+
+class EmbeddingClient:
+    """Connection to an EmbeddingServer. Not thread-safe: one per thread/retriever."""
+
+    def __init__(self, sock: socket.socket, model_name: str, dim: int):
+        self.sock = sock
+        self.model_name = model_name
+        self.dim = dim
+
+    @classmethod
+    def connect(cls, socket_path: str = DEFAULT_SOCKET, model_name: Optional[str] = None,
+                timeout: float = 10.0) -> Optional["EmbeddingClient"]:
+        """
+        None if no server is listening or it serves a different model.
+
+        `timeout` applies to every later send/recv too, so a hung server raises
+        socket.timeout instead of blocking the agent forever.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # Blocking connect: with a timeout set, a full listen backlog fails
+            # at once with EAGAIN on Unix sockets instead of waiting
+            sock.connect(socket_path)
+            sock.settimeout(timeout)
+            send_message(sock, {"op": "info"})
+            info, _ = recv_message(sock)
+        except (OSError, ConnectionError):
+            sock.close()
+            return None
+        if model_name and info["model"] != model_name:
+            sock.close()  # Embeddings from another model aren't comparable
+            return None
+        return cls(sock, info["model"], info["dim"])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        send_message(self.sock, {"texts": list(texts)})
+        header, payload = recv_message(self.sock)
+        if "error" in header:
+            raise RuntimeError(f"Embedding server error: {header['error']}")
+        return np.frombuffer(payload, dtype=np.float32).reshape(header["n"], header["dim"])
+
+    def close(self):
+        self.sock.close()
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+class SimulatedEncoder:
+    """
+    Stand-in with a transformer-like cost profile: a fixed per-call overhead
+    plus a small per-text cost. Used by the benchmark when sentence-transformers
+    isn't installed; embeddings are deterministic per text.
+    """
+
+    def __init__(self, dim: int = 384, call_overhead_ms: float = 4.0, per_text_ms: float = 0.15):
+        self.dim = dim
+        self.call_overhead = call_overhead_ms / 1000
+        self.per_text = per_text_ms / 1000
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts: List[str], convert_to_numpy: bool = True) -> np.ndarray:
+        time.sleep(self.call_overhead + self.per_text * len(texts))
+        return np.stack([
+            np.random.default_rng(abs(hash(t)) % (2 ** 32)).standard_normal(self.dim).astype(np.float32)
+            for t in texts
+        ])
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def benchmark(client_counts=(1, 2, 4, 8, 16), requests_per_client: int = 40, max_batch: int = 64):
+    """Each client sends single-text requests (one element at a time, like embed_element)."""
+    if HAS_SENTENCE_TRANSFORMERS:
+        encoder, label = SentenceTransformer(DEFAULT_MODEL), DEFAULT_MODEL
+    else:
+        encoder, label = SimulatedEncoder(), "simulated encoder (4ms/call + 0.15ms/text)"
+    print(f"Encoder: {label}, {requests_per_client} single-text requests per client")
+    print(f"{'mode':10s} {'clients':>7s} {'req/s':>8s} {'p50 ms':>8s} {'p99 ms':>8s} {'avg batch':>9s}")
+
+    for mode, batch, delay in [("unbatched", 1, 0.0), ("batched", max_batch, 5.0)]:
+        for n_clients in client_counts:
+            socket_path = os.path.join(tempfile.mkdtemp(), "embed.sock")
+            server = EmbeddingServer(socket_path, label, encoder=encoder, max_batch=batch, max_delay_ms=delay)
+            server.start()
+            latencies: List[float] = []
+            lock = threading.Lock()
+
+            def worker(client_idx: int):
+                client = EmbeddingClient.connect(socket_path)
+                mine = []
+                for i in range(requests_per_client):
+                    # Unique texts, so the cache doesn't hide encoder cost
+                    text = f"AXButton client{client_idx} element{i} run{n_clients}{mode}"
+                    start = time.perf_counter()
+                    client.encode([text])
+                    mine.append(time.perf_counter() - start)
+                client.close()
+                with lock:
+                    latencies.extend(mine)
+
+            threads = [threading.Thread(target=worker, args=(c,)) for c in range(n_clients)]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+
+            stats = server.batcher.stats
+            server.stop()
+            avg_batch = stats["batched_texts"] / max(stats["batches"], 1)
+            print(f"{mode:10s} {n_clients:7d} {len(latencies) / elapsed:8.0f} "
+                  f"{_percentile(latencies, 50) * 1000:8.2f} {_percentile(latencies, 99) * 1000:8.2f} "
+                  f"{avg_batch:9.1f}")
+
+
+def main():
+    if not HAS_NUMPY:
+        print("Install numpy: pip install numpy")
+        sys.exit(1)
+    args = sys.argv[1:]
+    if not args or args[0] not in ("serve", "bench"):
+        print(__doc__)
+        sys.exit(1)
+
+    if args[0] == "bench":
+        benchmark()
+        return
+
+    socket_path = args[args.index("--socket") + 1] if "--socket" in args else DEFAULT_SOCKET
+    model_name = args[args.index("--model") + 1] if "--model" in args else DEFAULT_MODEL
+    server = EmbeddingServer(socket_path, model_name)
+    print(f"[EmbeddingServer] Serving {model_name} (dim {server.dim}) on {socket_path}")
+    try:
+        server.start(background=False)
+    except RuntimeError as e:
+        print(f"[EmbeddingServer] {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+model_router.py - Model cascade for the agent loop
+
+Most turns in a run are routine ("call diff_ui after a click", "type into the
+field we just found"). They don't need the strongest model. The router sends
+those turns to a fast, cheap model and escalates to the strong model only when
+the run shows signs of trouble:
+
+    - a tool call failed, or observe_ui reported [ERROR DETECTED]
+    - diff_ui reported error/negative text
+    - diff_ui reported "no changes" N times in a row (the agent is stuck)
+    - the fast model proposed task_failed (confirmed by the strong model first)
+
+After an escalation the router stays on the strong model for a few turns
+before dropping back, so a recovery plan isn't abandoned halfway.
+
+Usage:
+    from model_router import ModelRouter, RouterConfig
+    result = run_agent("Safari", task, router=ModelRouter(RouterConfig()))
+
+    python3 model_router.py   # scripted demo with a mock client
+"""
+
+import json
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional
+
+
+@dataclass
+class ModelTier:
+    """One model in the cascade, with its pricing (USD per million tokens)."""
+    model: str
+    max_tokens: int
+    input_cost_per_mtok: float
+    output_cost_per_mtok: float
+
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return (input_tokens * self.input_cost_per_mtok +
+                output_tokens * self.output_cost_per_mtok) / 1_000_000
+
+
+FAST_TIER = ModelTier("claude-3-5-haiku-20241022", max_tokens=1024,
+                      input_cost_per_mtok=0.80, output_cost_per_mtok=4.0)
+STRONG_TIER = ModelTier("claude-sonnet-4-20250514", max_tokens=4096,
+                        input_cost_per_mtok=3.0, output_cost_per_mtok=15.0)
+
+
+@dataclass
+class RouterConfig:
+    """Models and escalation thresholds for the cascade."""
+    fast: ModelTier = field(default_factory=lambda: FAST_TIER)
+    strong: ModelTier = field(default_factory=lambda: STRONG_TIER)
+    no_change_threshold: int = 2      # consecutive "no changes" diffs before escalating
+    sticky_turns: int = 2             # turns to stay on strong after an escalation
+    strong_first_turn: bool = True    # let the strong model make the initial plan
+    confirm_task_failed: bool = True  # don't accept task_failed from the fast model
+    error_signals: List[str] = field(default_factory=lambda: [
+        "error/negative text appeared",
+        "[ERROR DETECTED]",
+    ])
+
+
+@dataclass
+class ModelUsage:
+    """Accumulated usage for one model."""
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    latency_s: float = 0.0
+    cost_usd: float = 0.0
+
+
+@dataclass
+class RoutingDecision:
+    turn: int
+    model: str
+    reason: str
+
+
+class ModelRouter:
+    """
+    Picks the model for each turn from signals in the previous tool results.
+
+    The agent loop calls select() before each LLM call, record_usage() after
+    it, and observe_tool() for every tool result it gets back from the bridge.
+    """
+
+    def __init__(self, config: Optional[RouterConfig] = None):
+        self.config = config or RouterConfig()
+        self.usage: Dict[str, ModelUsage] = {}
+        self.decisions: List[RoutingDecision] = []
+        self._turn = 0
+        self._no_change_streak = 0
+        self._strong_turns_left = 0
+        self._pending_reason: Optional[str] = None
+
+    def escalate(self, reason: str):
+        """Force the strong model for the next `sticky_turns` turns."""
+        self._pending_reason = reason
+        self._strong_turns_left = max(self._strong_turns_left, self.config.sticky_turns)
+
+    def select(self) -> ModelTier:
+        """Choose the model for the next turn and log why."""
+        if self._turn == 0 and self.config.strong_first_turn:
+            tier, reason = self.config.strong, "initial plan"
+        elif self._strong_turns_left > 0:
+            tier = self.config.strong
+            reason = self._pending_reason or "escalation hold"
+            self._strong_turns_left -= 1
+        else:
+            tier, reason = self.config.fast, "routine"
+        self._pending_reason = None
+
+        self.decisions.append(RoutingDecision(self._turn + 1, tier.model, reason))
+        self._turn += 1
+        return tier
+
+    def is_fast(self, tier: ModelTier) -> bool:
+        return tier.model == self.config.fast.model and tier.model != self.config.strong.model
+
+    def observe_tool(self, tool_name: str, result: Dict):
+        """Update escalation state from one tool result."""
+        if not result.get("success", True):
+            self.escalate(f"{tool_name} failed")
+            return
+
+        message = result.get("message", "") or ""
+        data = result.get("data") if isinstance(result.get("data"), dict) else {}
+        signals = data.get("signals") or []
+        if any(s in message or s in signals for s in self.config.error_signals):
+            self.escalate(f"error signal from {tool_name}")
+
+        if tool_name == "diff_ui":
+            if data.get("changed") is False or message.startswith("No changes detected"):
+                self._no_change_streak += 1
+                if self._no_change_streak >= self.config.no_change_threshold:
+                    self.escalate(f"{self._no_change_streak} no-change diffs")
+                    self._no_change_streak = 0
+            else:
+                self._no_change_streak = 0
+
+    def should_confirm_failure(self, tier: ModelTier) -> bool:
+        """True if a task_failed from this tier should be re-checked by the strong model."""
+        if self.config.confirm_task_failed and self.is_fast(tier):
+            self.escalate("confirm task_failed")
+            return True
+        return False
+
+    def record_usage(self, tier: ModelTier, response, latency_s: float):
+        usage = self.usage.setdefault(tier.model, ModelUsage())
+        in_tok = getattr(response.usage, "input_tokens", 0) if hasattr(response, "usage") else 0
+        out_tok = getattr(response.usage, "output_tokens", 0) if hasattr(response, "usage") else 0
+        usage.calls += 1
+        usage.input_tokens += in_tok
+        usage.output_tokens += out_tok
+        usage.latency_s += latency_s
+        usage.cost_usd += tier.cost(in_tok, out_tok)
+
+    def report(self) -> Dict:
+        """Per-model usage plus totals."""
+        models = {
+            model: {
+                "calls": u.calls,
+                "input_tokens": u.input_tokens,
+                "output_tokens": u.output_tokens,
+                "latency_s": round(u.latency_s, 3),
+                "cost_usd": round(u.cost_usd, 6),
+            }
+            for model, u in self.usage.items()
+        }
+        return {
+            "models": models,
+            "total_calls": sum(u.calls for u in self.usage.values()),
+            "total_latency_s": round(sum(u.latency_s for u in self.usage.values()), 3),
+            "total_cost_usd": round(sum(u.cost_usd for u in self.usage.values()), 6),
+            "decisions": [(d.turn, d.model, d.reason) for d in self.decisions],
+        }
+
+
+# =============================================================================
+# MOCK CLIENT + SCRIPTED DEMO
+# =============================================================================
+
+@dataclass
+class _Block:
+    type: str
+    text: str = ""
+    id: str = ""
+    name: str = ""
+    input: Dict = field(default_factory=dict)
+
+
+@dataclass
+class _Usage:
+    input_tokens: int
+    output_tokens: int
+
+
+@dataclass
+class _Response:
+    content: List[_Block]
+    stop_reason: str
+    usage: _Usage
+
+
+class MockClient:
+    """
+    Stand-in for anthropic.Anthropic that replays a scripted list of tool calls.
+
+    Each script entry is (tool_name, tool_input) or (tool_name, tool_input, model)
+    where `model` restricts the entry to that model (e.g. a task_failed that only
+    the fast model would propose). Latency is simulated per model by sleeping
+    `latency_per_token` seconds per output token.
+    """
+
+    def __init__(self, script: List[tuple], latency_per_token: Dict[str, float],
+                 output_tokens: int = 60):
+        self.script = list(script)
+        self.latency_per_token = latency_per_token
+        self.output_tokens = output_tokens
+        self.messages = self
+        self._pos = 0
+        self._ids = 0
+
+    def create(self, model: str, max_tokens: int, system: str, tools: List, messages: List):
+        entry = ("task_failed", {"reason": "script exhausted"})
+        while self._pos < len(self.script):
+            candidate = self.script[self._pos]
+            self._pos += 1
+            if len(candidate) == 3 and candidate[2] != model:
+                continue  # only that model would make this call
+            entry = candidate
+            break
+
+        self._ids += 1
+        input_tokens = sum(len(str(m)) for m in messages) // 4 + len(system) // 4
+        time.sleep(self.latency_per_token.get(model, 0.0) * self.output_tokens)
+        return _Response(
+            content=[_Block("tool_use", id=f"toolu_{self._ids}", name=entry[0], input=entry[1])],
+            stop_reason="tool_use",
+            usage=_Usage(input_tokens, self.output_tokens),
+        )
+
+
+class ScriptedBridge:
+    """Stand-in for AppAgentBridge returning canned results per tool."""
+
+    def __init__(self, results: Dict[str, List[Dict]]):
+        self.results = {k: list(v) for k, v in results.items()}
+
+    def start(self):
+        pass
+
+    def call(self, tool: str, params: dict = None) -> dict:
+        queue = self.results.get(tool)
+        if queue:
+            return queue.pop(0) if len(queue) > 1 else queue[0]
+        return {"success": True, "message": f"{tool} ok", "data": None}
+
+    def stop(self):
+        pass
+
+
+def _demo_scenario():
+    no_change = {"success": True, "message": "No changes detected. ",
+                 "data": {"changed": False, "signals": []}}
+    changed = {"success": True, "message": "UI changed: 3 added. Signals: minor UI change",
+               "data": {"changed": True, "signals": ["minor UI change"]}}
+    error = {"success": True, "message": "UI changed: 2 added. Signals: error/negative text appeared",
+             "data": {"changed": True, "signals": ["error/negative text appeared"]}}
+
+    script = [
+        ("observe_ui", {}),
+        ("click", {"element_id": "e12"}),
+        ("diff_ui", {}),
+        ("type", {"element_id": "e14", "text": "claude"}),
+        ("diff_ui", {}),
+        ("press_key", {"key": "return"}),
+        ("diff_ui", {}),
+        ("click", {"element_id": "e20"}),
+        ("diff_ui", {}),
+        ("task_failed", {"reason": "Search button does nothing"}, FAST_TIER.model),
+        ("observe_ui", {}),
+        ("click", {"element_id": "e31"}),
+        ("diff_ui", {}),
+        ("click", {"element_id": "e33"}),
+        ("diff_ui", {}),
+        ("task_complete", {"summary": "Searched for 'claude'"}),
+    ]
+    bridge_results = {
+        "observe_ui": [{"success": True, "message": "Observed 140 elements. State: content_view",
+                        "data": {"elements": []}}],
+        "diff_ui": [changed, error, changed, no_change, no_change, changed, changed],
+    }
+    return script, bridge_results
+
+
+def demo():
+    """Run the same scripted task with and without the cascade and compare."""
+    from agent_loop import run_agent
+
+    latency = {FAST_TIER.model: 0.0001, STRONG_TIER.model: 0.0004}
+    strong_only = RouterConfig(fast=STRONG_TIER, strong=STRONG_TIER)
+
+    runs = {}
+    for label, config in [("strong-only", strong_only), ("cascade", RouterConfig())]:
+        script, bridge_results = _demo_scenario()
+        router = ModelRouter(config)
+        result = run_agent(
+            "Safari", "Search for 'claude'", verbose=False,
+            client=MockClient(script, latency),
+            bridge=ScriptedBridge(bridge_results),
+            router=router,
+        )
+        runs[label] = (result, router.report())
+
+    for label, (result, report) in runs.items():
+        print(f"=== {label}: success={result.get('success')} ===")
+        for turn, model, reason in report["decisions"]:
+            print(f"  turn {turn:2d}: {model:28s} ({reason})")
+        print(json.dumps(report["models"], indent=2))
+
+    base, cascade = runs["strong-only"][1], runs["cascade"][1]
+    print("\n=== savings ===")
+    print(f"  latency: {base['total_latency_s']:.3f}s -> {cascade['total_latency_s']:.3f}s "
+          f"({1 - cascade['total_latency_s'] / base['total_latency_s']:.0%} saved)")
+    print(f"  cost:    ${base['total_cost_usd']:.4f} -> ${cascade['total_cost_usd']:.4f} "
+          f"({1 - cascade['total_cost_usd'] / base['total_cost_usd']:.0%} saved)")
+
+
+if __name__ == "__main__":
+    demo()
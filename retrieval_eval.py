@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+retrieval_eval.py - Quality and latency benchmark for ElementRetriever
+
+Replays TrajectoryStep records through one or more retriever configurations
+and measures, for each:
+
+    recall@k     fraction of steps whose chosen element is in the top k
+    MRR          mean reciprocal rank of the chosen element (0 if missed)
+    tokens saved compact-encoded tokens for the top k vs. all elements
+    latency      p50 / p95 / p99 per retrieve() call
+
+so k, encoder, caching and index type (flat vs. path-trie scoping) can be
+tuned from data instead of guessed.
+
+Trajectories are JSONL, one Trajectory per line, in the shape of the
+dataclasses in element_retriever.py (see save_trajectories). Without a file
+a synthetic set is generated.
+
+Usage:
+    python3 retrieval_eval.py                                  # synthetic steps
+    python3 retrieval_eval.py --trajectories runs.jsonl        # recorded steps
+    python3 retrieval_eval.py --save report.json               # keep results
+    python3 retrieval_eval.py --baseline report.json           # compare with a previous run
+
+Note: without sentence-transformers the retriever falls back to random
+embeddings, so recall is chance-level except where hierarchy scoping applies.
+"""
+
+import json
+import random
+import sys
+import time
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Optional
+
+from element_retriever import (
+    ElementRetriever,
+    NavigationContext,
+    PathTrie,
+    Trajectory,
+    TrajectoryStep,
+    UIElement,
+    HAS_NUMPY,
+    HAS_SENTENCE_TRANSFORMERS,
+    np,
+)
+from ui_codec import approx_tokens, encode_elements
+
+
+# =============================================================================
+# TRAJECTORY I/O
+# =============================================================================
+
+def save_trajectories(trajectories: List[Trajectory], path: str):
+    with open(path, "w") as f:
+        for trajectory in trajectories:
+            f.write(json.dumps(asdict(trajectory)) + "\n")
+
+
+def load_trajectories(path: str) -> List[Trajectory]:
+    trajectories = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            steps = [
+                TrajectoryStep(
+                    **{**step,
+                       "context": NavigationContext(**step["context"]),
+                       "all_elements": [UIElement(**e) for e in step["all_elements"]]}
+                )
+                for step in data["steps"]
+            ]
+            trajectories.append(Trajectory(data["task"], data["app_name"], steps, data["completed"]))
+    return trajectories
+
+
+def synthetic_trajectories(n_steps: int = 200, n_rows: int = 60, seed: int = 0) -> List[Trajectory]:
+    """
+    Mail/chat-like screens: toolbar, sidebar folders, a long message list,
+    a compose area, and sometimes a save sheet. Each step names one target.
+    """
+    rng = random.Random(seed)
+    names = ["Ben", "Alice", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi", "Ivan", "Judy"]
+    folders = ["Inbox", "Sent", "Drafts", "Archive", "Junk", "Trash"]
+    toolbar = ["Back", "Forward", "Reply", "Forward Message", "Delete", "Flag", "Share", "Search"]
+
+    def screen(with_sheet: bool) -> List[UIElement]:
+        elements: List[UIElement] = []
+
+        def add(role, parent_path, **kwargs) -> str:
+            path = f"{parent_path} > {role}" if parent_path else role
+            elements.append(UIElement(f"e{len(elements)}", role, path=path, **kwargs))
+            return path
+
+        app = add("AXApplication", "", title="Mail")
+        win = add("AXWindow", app, title="Mail", actions=["AXRaise"])
+        tb = add("AXToolbar", win)
+        for title in toolbar:
+            add("AXButton", tb, title=title, actions=["AXPress"])
+        split = add("AXSplitGroup", win)
+        outline = add("AXOutline", split)
+        for folder in folders:
+            row = add("AXRow", outline, actions=["AXPress"])
+            add("AXStaticText", row, value=folder)
+        table = add("AXTable", split)
+        for i in range(n_rows):
+            name = rng.choice(names)
+            add("AXRow", table, value=f"Message from {name}: {rng.choice(['Lunch?', 'Report', 'Hey!', 'Invoice'])} #{i}",
+                actions=["AXPress"])
+        compose = add("AXGroup", split)
+        add("AXTextArea", compose, title="Type a message", actions=["AXPress"])
+        add("AXButton", compose, title="Send", actions=["AXPress"])
+        add("AXButton", compose, title="Attach", actions=["AXPress"])
+        if with_sheet:
+            sheet = add("AXSheet", win)
+            add("AXStaticText", sheet, value="Save changes to this draft?")
+            for title in ["Save", "Don't Save", "Cancel"]:
+                add("AXButton", sheet, title=title, actions=["AXPress"])
+        return elements
+
+    def pick(elements: List[UIElement], predicate) -> UIElement:
+        return rng.choice([e for e in elements if predicate(e)])
+
+    steps = []
+    for _ in range(n_steps):
+        kind = rng.choice(["open", "folder", "toolbar", "compose", "send", "save"])
+        elements = screen(with_sheet=kind == "save")
+        if kind == "open":
+            sender = pick(elements, lambda e: e.role == "AXRow" and (e.value or "").startswith("Message"))
+            prefix = sender.value.split(":")[0] + ":"
+            # Rows are numbered oldest first, so the latest is the last one
+            target = [e for e in elements if e.role == "AXRow" and (e.value or "").startswith(prefix)][-1]
+            task = f"Open the latest message from {prefix[len('Message from '):-1]}"
+        elif kind == "folder":
+            folder = rng.choice(folders)
+            # The row is actionable, its text child is not
+            text = pick(elements, lambda e: e.value == folder)
+            target = next(e for e in reversed(elements[:elements.index(text)]) if e.role == "AXRow")
+            task = f"Go to the {folder} folder"
+        elif kind == "toolbar":
+            title = rng.choice(toolbar)
+            target = pick(elements, lambda e: e.title == title)
+            task = f"{title} this message"
+        elif kind == "compose":
+            target = pick(elements, lambda e: e.role == "AXTextArea")
+            task = f"Write a reply to {rng.choice(names)}"
+        elif kind == "send":
+            target = pick(elements, lambda e: e.title == "Send")
+            task = "Send the message I just wrote"
+        else:
+            target = pick(elements, lambda e: e.title == "Save" and "AXSheet" in e.path)
+            task = "Close the draft but keep my changes"
+
+        context = NavigationContext(current_path=["AXApplication", "AXWindow"], hypothesis="Mail main window")
+        steps.append(TrajectoryStep(task, context, elements, target.id, "click", {}, True))
+
+    return [Trajectory("synthetic", "Mail", steps, True)]
+
+
+# =============================================================================
+# EVALUATION
+# =============================================================================
+
+@dataclass
+class RetrieverConfig:
+    name: str
+    k: int = 20
+    model_name: str = "all-MiniLM-L6-v2"
+    use_cache: bool = True   # Keep element embeddings across queries
+    index: str = "trie"      # "flat" = score all candidates, "trie" = hierarchy scoping
+    server_socket: Optional[str] = None
+
+
+@dataclass
+class EvalReport:
+    config: str
+    queries: int
+    recall: Dict[int, float]
+    mrr: float
+    tokens_all: int
+    tokens_retrieved: int
+    latency_ms: Dict[str, float]
+    skipped: int = 0
+
+    @property
+    def tokens_saved(self) -> float:
+        return 1 - self.tokens_retrieved / self.tokens_all if self.tokens_all else 0.0
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def _tokens(elements: List[UIElement]) -> int:
+    return approx_tokens("\n".join(encode_elements([asdict(e) for e in elements])))
+
+
+def _tied_ranks(results: list, element_id: str) -> Optional[range]:
+    """
+    Ranks the element could occupy, given that equal scores are in no real
+    order (retrieve() returns dummy 1.0 scores when all candidates fit in k).
+    """
+    for e, score in results:
+        if e.id == element_id:
+            tied = [i for i, (_, s) in enumerate(results) if s == score]  # Contiguous: results are sorted
+            return range(tied[0] + 1, tied[-1] + 2)
+    return None
+
+
+def evaluate(
+    config: RetrieverConfig,
+    steps: List[TrajectoryStep],
+    retriever: Optional[ElementRetriever] = None,
+    seed: int = 0
+) -> EvalReport:
+    """
+    Replay steps through one retriever configuration.
+
+    Ties count at their expected value: an element tied with m others over
+    ranks a..b is a hit@c with probability |[a, min(b, c)]| / m.
+    """
+    if HAS_NUMPY:
+        np.random.seed(seed)  # The no-encoder fallback embeds at random
+    retriever = retriever or ElementRetriever(config.model_name, server_socket=config.server_socket)
+    cutoffs = sorted({c for c in (1, 5, 10, config.k) if c <= config.k})
+    hits = {c: 0 for c in cutoffs}
+    reciprocal_ranks, latencies = [], []
+    tokens_all = tokens_retrieved = skipped = 0
+
+    for step in steps:
+        actionable = {e.id for e in step.all_elements if e.is_actionable}
+        if step.chosen_element_id not in actionable:
+            skipped += 1  # retrieve() can never return it
+            continue
+        if not config.use_cache:
+            retriever.clear_cache()
+
+        started = time.perf_counter()
+        if config.index == "trie":
+            trie = PathTrie(step.all_elements)
+            results = retriever.retrieve(step.task, step.all_elements, step.context, k=config.k, trie=trie)
+        else:
+            results = retriever.retrieve(step.task, step.all_elements, step.context, k=config.k, scope=None)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        ranks = _tied_ranks(results, step.chosen_element_id) or range(0)
+        for c in cutoffs:
+            hits[c] += sum(r <= c for r in ranks) / len(ranks) if ranks else 0.0
+        reciprocal_ranks.append(sum(1 / r for r in ranks) / len(ranks) if ranks else 0.0)
+        tokens_all += _tokens(step.all_elements)
+        tokens_retrieved += _tokens([e for e, _ in results])
+
+    n = len(reciprocal_ranks)
+    return EvalReport(
+        config=config.name,
+        queries=n,
+        recall={c: hits[c] / n if n else 0.0 for c in cutoffs},
+        mrr=sum(reciprocal_ranks) / n if n else 0.0,
+        tokens_all=tokens_all,
+        tokens_retrieved=tokens_retrieved,
+        latency_ms={
+            "mean": sum(latencies) / n if n else 0.0,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+        },
+        skipped=skipped,
+    )
+
+
+def run_configs(configs: List[RetrieverConfig], steps: List[TrajectoryStep]) -> List[EvalReport]:
+    """Evaluate several configs, sharing one retriever per encoder backend."""
+    retrievers: Dict[tuple, ElementRetriever] = {}
+    reports = []
+    for config in configs:
+        key = (config.model_name, config.server_socket)
+        if key not in retrievers:
+            retrievers[key] = ElementRetriever(config.model_name, server_socket=config.server_socket)
+        retrievers[key].clear_cache()  # Every config starts cold
+        reports.append(evaluate(config, steps, retrievers[key]))
+    return reports
+
+
+def compare(reports: List[EvalReport], baseline: Optional[List[EvalReport]] = None):
+    """Print reports side by side, with MRR/p50 deltas against a baseline run if given."""
+    base = {r.config: r for r in baseline or []}
+    print(f"{'config':22s} {'n':>5s} {'R@1':>6s} {'R@5':>6s} {'R@k':>6s} {'MRR':>6s} "
+          f"{'saved':>6s} {'p50ms':>7s} {'p99ms':>7s}")
+    for r in reports:
+        k = max(r.recall)
+        line = (f"{r.config:22s} {r.queries:5d} {r.recall.get(1, 0):6.2f} {r.recall.get(5, 0):6.2f} "
+                f"{r.recall[k]:6.2f} {r.mrr:6.3f} {r.tokens_saved:6.0%} "
+                f"{r.latency_ms['p50']:7.2f} {r.latency_ms['p99']:7.2f}")
+        if r.config in base:
+            b = base[r.config]
+            line += f"   ΔMRR {r.mrr - b.mrr:+.3f} Δp50 {r.latency_ms['p50'] - b.latency_ms['p50']:+.2f}ms"
+        print(line)
+
+
+def save_reports(reports: List[EvalReport], path: str):
+    with open(path, "w") as f:
+        json.dump([asdict(r) for r in reports], f, indent=2)
+
+
+def load_reports(path: str) -> List[EvalReport]:
+    with open(path) as f:
+        data = json.load(f)
+    for r in data:
+        r["recall"] = {int(k): v for k, v in r["recall"].items()}
+    return [EvalReport(**r) for r in data]
+
+
+DEFAULT_CONFIGS = [
+    RetrieverConfig("flat k=5", k=5, index="flat"),
+    RetrieverConfig("flat k=10", k=10, index="flat"),
+    RetrieverConfig("flat k=20", k=20, index="flat"),
+    RetrieverConfig("trie k=10", k=10, index="trie"),
+    RetrieverConfig("trie k=20", k=20, index="trie"),
+    RetrieverConfig("trie k=20 no cache", k=20, index="trie", use_cache=False),
+]
+
+
+def main():
+    args = sys.argv[1:]
+
+    def option(name: str) -> Optional[str]:
+        return args[args.index(name) + 1] if name in args else None
+
+    if option("--trajectories"):
+        trajectories = load_trajectories(option("--trajectories"))
+    else:
+        trajectories = synthetic_trajectories()
+    steps = [s for t in trajectories for s in t.steps if s.success]
+
+    encoder = "sentence-transformers" if HAS_SENTENCE_TRANSFORMERS else "random embeddings (no sentence-transformers)"
+    print(f"{len(steps)} steps, encoder: {encoder}\n")
+
+    reports = run_configs(DEFAULT_CONFIGS, steps)
+    baseline = load_reports(option("--baseline")) if option("--baseline") else None
+    compare(reports, baseline)
+
+    if option("--save"):
+        save_reports(reports, option("--save"))
+        print(f"\nSaved to {option('--save')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+session_checkpoint.py - Checkpoint and resume for agent_loop sessions
+
+run_agent writes a checkpoint after every turn: the message history, the
+NavigationContext, the last snapshot hash and the turn count. If the Python
+process dies, run_agent(..., resume=True) reloads the checkpoint, re-observes
+the UI (element ids from before the crash are stale) and continues from the
+next turn, without repeating the LLM calls that were already made.
+
+Crashes of the Swift AppAgent process itself are handled by AppAgentBridge,
+which restarts it and re-observes the UI (see AppAgentBridge.call).
+
+Usage:
+    python3 agent_loop.py Safari "..."            # checkpoints to /tmp
+    python3 agent_loop.py Safari "..." --resume   # continue after a crash
+
+    python3 session_checkpoint.py   # crash/resume demo with a stub agent
+"""
+
+import json
+import os
+import sys
+import tempfile
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Optional
+
+from element_retriever import NavigationContext
+
+
+def block_to_dict(block) -> Dict:
+    """Plain-dict form of an SDK content block (what the API accepts back)."""
+    if isinstance(block, dict):
+        return block
+    if block.type == "text":
+        return {"type": "text", "text": block.text}
+    if block.type == "tool_use":
+        return {"type": "tool_use", "id": block.id, "name": block.name, "input": block.input}
+    if hasattr(block, "model_dump"):
+        return block.model_dump()
+    raise TypeError(f"Cannot serialize content block of type {block.type!r}")
+
+
+def message_to_dict(message: Dict) -> Dict:
+    content = message["content"]
+    if isinstance(content, list):
+        content = [block_to_dict(b) for b in content]
+    return {"role": message["role"], "content": content}
+
+
+@dataclass
+class SessionCheckpoint:
+    """Everything run_agent needs to continue a session."""
+    app_name: str
+    task: str
+    turn: int
+    messages: List[Dict]
+    context: NavigationContext
+    snapshot_hash: Optional[str] = None
+    latest_observation: Optional[list] = None  # ObservationHistory state
+
+    def save(self, path: str):
+        """Write atomically so a crash mid-write never leaves a corrupt file."""
+        data = asdict(self)
+        data["messages"] = [message_to_dict(m) for m in self.messages]
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SessionCheckpoint"]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        data["context"] = NavigationContext(**data["context"])
+        return cls(**data)
+
+
+# =============================================================================
+# STUB AGENT + DEMO
+# =============================================================================
+
+STUB_AGENT = '''
+import json, sys
+observations = 0
+for line in sys.stdin:
+    request = json.loads(line)
+    tool, params = request["tool"], request.get("params") or {}
+    if tool == "click" and params.get("element_id") == "crash":
+        sys.exit(3)  # die without answering, like a segfaulting AppAgent
+    if tool == "observe_ui":
+        observations += 1
+        elements = [
+            {"id": "e0", "role": "AXWindow", "title": "Stub", "actions": [], "enabled": True, "path": "AXWindow"},
+            {"id": "e1", "role": "AXButton", "title": "OK", "actions": ["AXPress"], "enabled": True,
+             "path": "AXWindow > AXButton"},
+        ]
+        hints = {"inferredState": "content_view", "visibleText": [], "hasTextField": False}
+        result = {"success": True, "message": f"Observed 2 elements (observation {observations})",
+                  "data": {"appName": "Stub", "pid": 1, "hash": str(observations), "focusedElement": "e1",
+                           "elements": elements, "hints": hints}}
+    else:
+        result = {"success": True, "message": f"{tool} ok", "data": None}
+    print(json.dumps(result), flush=True)
+'''
+
+
+def demo():
+    """Crash the stub agent mid-run, then kill and resume the whole session."""
+    from agent_loop import run_agent, AppAgentBridge
+    from model_router import MockClient
+
+    workdir = tempfile.mkdtemp()
+    stub_path = os.path.join(workdir, "stub_agent.py")
+    with open(stub_path, "w") as f:
+        f.write(STUB_AGENT)
+    checkpoint_path = os.path.join(workdir, "session.json")
+
+    def bridge():
+        return AppAgentBridge("Stub", command=[sys.executable, stub_path])
+
+    print("=== 1. AppAgent crash: bridge restarts it and re-observes ===")
+    script = [("observe_ui", {}), ("click", {"element_id": "crash"}),
+              ("click", {"element_id": "e1"}), ("task_complete", {"summary": "Clicked OK"})]
+    result = run_agent("Stub", "Click OK", verbose=True, client=MockClient(script, {}), bridge=bridge())
+    print(f"-> success={result['success']}")
+
+    print("\n=== 2. Python process dies at turn 3, then resumes ===")
+    script = [("observe_ui", {}), ("click", {"element_id": "e1"}), ("observe_ui", {}),
+              ("observe_ui", {}), ("click", {"element_id": "e1"}),
+              ("task_complete", {"summary": "Clicked OK twice"})]
+
+    class DyingClient(MockClient):
+        def create(self, **kwargs):
+            if self._pos == 3:
+                raise KeyboardInterrupt("simulated crash")
+            return super().create(**kwargs)
+
+    class RecordingClient(MockClient):
+        def create(self, **kwargs):
+            self.last_messages = kwargs["messages"]
+            return super().create(**kwargs)
+
+    first_client, first_bridge = DyingClient(script, {}), bridge()
+    try:
+        run_agent("Stub", "Click OK twice", verbose=False, client=first_client,
+                  bridge=first_bridge, checkpoint_path=checkpoint_path)
+    except KeyboardInterrupt:
+        first_bridge.stop()
+    saved = SessionCheckpoint.load(checkpoint_path)
+    print(f"crashed; checkpoint at turn {saved.turn}, {len(saved.messages)} messages, "
+          f"hash={saved.snapshot_hash}, context:\n{saved.context.to_text()}")
+
+    resumed_client = RecordingClient(script[first_client._pos:], {})
+    result = run_agent("Stub", "Click OK twice", verbose=True, client=resumed_client,
+                       bridge=bridge(), checkpoint_path=checkpoint_path, resume=True)
+
+    # Turn 3 observed right before the crash; the resume observation gets its
+    # own slot and label, and both are superseded in place
+    blocks = [block_to_dict(b) for m in resumed_client.last_messages if isinstance(m["content"], list)
+              for b in m["content"]]
+    assert not any(b.get("type") == "text" and "content" in b for b in blocks)
+    stubs = [b["content"] for b in blocks if str(b.get("content", "")).startswith("[observe_ui")]
+    labels = [stub.split(",")[0] for stub in stubs]
+    assert len(labels) == len(set(labels)), labels
+    print("superseded observations:\n  " + "\n  ".join(stubs))
+    llm_calls = first_client._pos + resumed_client._pos
+    print(f"-> success={result['success']}, LLM calls: {llm_calls} for {len(script)} scripted turns "
+          f"(no repeats), checkpoint removed: {not os.path.exists(checkpoint_path)}")
+
+
+if __name__ == "__main__":
+    demo()
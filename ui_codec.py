@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+ui_codec.py - Compact, token-efficient rendering of UI snapshots and diffs
+
+observe_ui / diff_ui results are large: the raw JSON repeats "role", "subrole",
+"actions", "path" for every element and spells out paths like
+"AXApplication > AXWindow > AXGroup > AXScrollArea > AXWebArea > AXGroup > AXLink"
+in full. The LLM doesn't need any of that repetition.
+
+Encoded snapshot:
+
+    ok Observed 142 elements. State: content_view
+    snapshot app="Safari" pid=812 focus=e7 hash=88213 state=content_view flags=text,buttons
+    text ["Google", "Search"]
+    e0 app "Safari"
+     e1 win "Google"
+      e2 tb
+       e3 btn "Back" [p]
+       e4 btn "Forward" ! [p]
+       e5 fld/SearchField ="google.com" [p,c]
+
+- Indentation is tree depth; an element's path is its parent's path plus its
+  own role, so paths are never spelled out. When an element doesn't continue
+  the current branch (diff sections are unordered) a "@ app>win>grp" line
+  re-anchors the branch.
+- Roles and common actions use short codes (ROLE_CODES, ACTION_CODES).
+  Names that aren't plain AX identifiers (custom actions, odd roles) are
+  JSON-quoted.
+- Defaults are omitted: enabled=true, no subrole, no title/value, no actions.
+  A lone "!" marks a disabled element.
+- Titles and values are truncated to `max_text` characters with a trailing "…".
+- Header fields are key=value; the app name (free text, e.g. "System
+  Settings") is JSON-quoted like titles, other values only if they need it.
+
+Element ids, roles, subroles, paths, enabled flags and actions survive
+decode(encode(x)) exactly, so any id the LLM reads still resolves in AppAgent.
+Only long titles/values are lossy.
+
+Usage:
+    from ui_codec import encode_result, decode_result
+    text = encode_result(bridge.call("observe_ui"))
+
+    python3 ui_codec.py   # measure token reduction on a sample snapshot
+"""
+
+import json
+import re
+from typing import List, Dict, Optional, Tuple
+
+# Optional dependencies
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+
+ROLE_CODES = {
+    "AXApplication": "app",
+    "AXWindow": "win",
+    "AXSheet": "sheet",
+    "AXDialog": "dlg",
+    "AXGroup": "grp",
+    "AXToolbar": "tb",
+    "AXSplitGroup": "split",
+    "AXSplitter": "splitter",
+    "AXScrollArea": "scroll",
+    "AXScrollBar": "sbar",
+    "AXWebArea": "web",
+    "AXTabGroup": "tabs",
+    "AXButton": "btn",
+    "AXMenuButton": "mbtn",
+    "AXPopUpButton": "popup",
+    "AXCheckBox": "chk",
+    "AXRadioButton": "radio",
+    "AXRadioGroup": "radios",
+    "AXTextField": "fld",
+    "AXTextArea": "area",
+    "AXComboBox": "combo",
+    "AXStaticText": "txt",
+    "AXHeading": "h",
+    "AXLink": "link",
+    "AXImage": "img",
+    "AXList": "list",
+    "AXTable": "tbl",
+    "AXOutline": "outl",
+    "AXRow": "row",
+    "AXColumn": "col",
+    "AXCell": "cell",
+    "AXMenuBar": "mbar",
+    "AXMenuBarItem": "mbi",
+    "AXMenu": "menu",
+    "AXMenuItem": "mi",
+    "AXSlider": "slider",
+    "AXProgressIndicator": "prog",
+    "AXBusyIndicator": "busy",
+    "AXUnknown": "unk",
+}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+ACTION_CODES = {
+    "AXPress": "p",
+    "AXShowMenu": "m",
+    "AXConfirm": "c",
+    "AXCancel": "x",
+    "AXRaise": "r",
+    "AXPick": "k",
+    "AXIncrement": "+",
+    "AXDecrement": "-",
+    "AXScrollToVisible": "s",
+}
+ACTION_NAMES = {code: action for action, code in ACTION_CODES.items()}
+
+HINT_FLAGS = [
+    ("hasModalDialog", "modal"),
+    ("hasErrorIndicator", "error"),
+    ("hasLoadingIndicator", "loading"),
+    ("hasTextField", "text"),
+    ("hasEnabledButtons", "buttons"),
+]
+
+ELLIPSIS = "…"
+
+
+# =============================================================================
+# NAME CODES
+# =============================================================================
+
+_PLAIN_AX_NAME = re.compile(r"AX[A-Z][A-Za-z0-9]*")
+_NAME_STOPS = " /,]>"
+
+
+def _encode_ax(name: str, codes: Dict[str, str]) -> str:
+    """
+    Short code for a known AX name, the bare name for other plain AX names,
+    and a JSON string for anything else. Custom actions such as
+    "Name:Copy\nTarget:0x0\nSelector:(null)" are quoted, so they can't
+    break the line or the [..] list.
+    """
+    if name in codes:
+        return codes[name]
+    if _PLAIN_AX_NAME.fullmatch(name):
+        return name[2:]  # Codes are lowercase, bare names start uppercase
+    return json.dumps(name, ensure_ascii=False)
+
+
+def _read_name(text: str, pos: int, names: Dict[str, str]) -> Tuple[str, int]:
+    """Inverse of _encode_ax, reading one name starting at pos."""
+    if text.startswith('"', pos):
+        return _read_string(text, pos)
+    end = pos
+    while end < len(text) and text[end] not in _NAME_STOPS:
+        end += 1
+    token = text[pos:end]
+    return names.get(token, "AX" + token), end
+
+
+def encode_role(role: str) -> str:
+    return _encode_ax(role, ROLE_CODES)
+
+
+def decode_role(token: str) -> str:
+    return _read_name(token, 0, ROLE_NAMES)[0]
+
+
+def _split_path(path: str) -> List[str]:
+    return [p.strip() for p in path.split(">")] if path else []
+
+
+def _truncate(text: str, max_text: int) -> str:
+    if max_text and len(text) > max_text:
+        return text[:max_text] + ELLIPSIS
+    return text
+
+
+def _quote(text: str, max_text: int) -> str:
+    return json.dumps(_truncate(text, max_text), ensure_ascii=False)
+
+
+# =============================================================================
+# ELEMENTS
+# =============================================================================
+
+def _element_line(element: Dict, depth: int, max_text: int) -> str:
+    head = encode_role(element["role"])
+    if element.get("subrole"):
+        head += "/" + _encode_ax(element["subrole"], {})
+    parts = [" " * depth + element["id"], head]
+    if element.get("title"):
+        parts.append(_quote(element["title"], max_text))
+    if element.get("value"):
+        parts.append("=" + _quote(element["value"], max_text))
+    if not element.get("enabled", True):
+        parts.append("!")
+    if element.get("actions"):
+        parts.append("[" + ",".join(_encode_ax(a, ACTION_CODES) for a in element["actions"]) + "]")
+    return " ".join(parts)
+
+
+def encode_elements(elements: List[Dict], max_text: int = 80) -> List[str]:
+    """Render flat elements as an indented tree, re-anchoring with '@' lines."""
+    lines = []
+    branch: List[str] = []  # Path segments of the previous element
+    for element in elements:
+        path = _split_path(element.get("path", "")) or [element["role"]]
+        parent = path[:-1]
+        if branch[:len(parent)] != parent:
+            lines.append("@ " + ">".join(encode_role(r) for r in parent))
+        lines.append(_element_line(element, len(parent), max_text))
+        branch = path
+    return lines
+
+
+def _read_string(text: str, pos: int) -> Tuple[str, int]:
+    value, end = json.JSONDecoder().raw_decode(text, pos)
+    return value, end
+
+
+def _parse_element_line(line: str, branch: List[str]) -> Dict:
+    depth = len(line) - len(line.lstrip(" "))
+    element_id, _, rest = line[depth:].partition(" ")
+    role, pos = _read_name(rest, 0, ROLE_NAMES)
+    subrole = None
+    if rest.startswith("/", pos):
+        subrole, pos = _read_name(rest, pos + 1, {})
+
+    element = {
+        "id": element_id,
+        "role": role,
+        "subrole": subrole,
+        "title": None,
+        "value": None,
+        "actions": [],
+        "enabled": True,
+        "path": " > ".join(branch[:depth] + [role]),
+    }
+
+    while pos < len(rest):
+        ch = rest[pos]
+        if ch == " ":
+            pos += 1
+        elif ch == '"':
+            element["title"], pos = _read_string(rest, pos)
+        elif ch == "=":
+            element["value"], pos = _read_string(rest, pos + 1)
+        elif ch == "!":
+            element["enabled"] = False
+            pos += 1
+        elif ch == "[":
+            pos += 1
+            while not rest.startswith("]", pos):
+                action, pos = _read_name(rest, pos, ACTION_NAMES)
+                element["actions"].append(action)
+                if rest.startswith(",", pos):
+                    pos += 1
+            pos += 1
+        else:
+            raise ValueError(f"Unexpected token in element line: {line!r}")
+    return element
+
+
+def _parse_anchor(anchor: str) -> List[str]:
+    branch, pos = [], 0
+    while pos < len(anchor):
+        role, pos = _read_name(anchor, pos, ROLE_NAMES)
+        branch.append(role)
+        pos += 1  # ">"
+    return branch
+
+
+def decode_elements(lines: List[str]) -> List[Dict]:
+    elements = []
+    branch: List[str] = []
+    for line in lines:
+        if line.startswith("@"):
+            branch = _parse_anchor(line[1:].strip())
+            continue
+        element = _parse_element_line(line, branch)
+        branch = _split_path(element["path"])
+        elements.append(element)
+    return elements
+
+
+# =============================================================================
+# SNAPSHOTS, DIFFS, TOOL RESULTS
+# =============================================================================
+
+def _header_value(value, quote: bool = False) -> str:
+    text = str(value)
+    if quote or not text or any(c.isspace() or c in '"=' for c in text):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+def _parse_header(line: str) -> Dict[str, str]:
+    """key=value tokens after the leading word; values may be JSON strings."""
+    fields = {}
+    pos = line.find(" ")
+    while 0 <= pos < len(line):
+        if line[pos] == " ":
+            pos += 1
+            continue
+        eq = line.index("=", pos)
+        key = line[pos:eq]
+        if line.startswith('"', eq + 1):
+            fields[key], pos = _read_string(line, eq + 1)
+        else:
+            end = line.find(" ", eq + 1)
+            end = len(line) if end < 0 else end
+            fields[key], pos = line[eq + 1:end], end
+    return fields
+
+
+def encode_snapshot(snapshot: Dict, max_text: int = 80) -> List[str]:
+    hints = snapshot.get("hints") or {}
+    header = ["snapshot"]
+    if snapshot.get("appName") is not None:
+        header.append("app=" + _header_value(snapshot["appName"], quote=True))
+    for key, label in [("pid", "pid"), ("focusedElement", "focus"), ("hash", "hash")]:
+        if snapshot.get(key) is not None:
+            header.append(f"{label}={_header_value(snapshot[key])}")
+    if hints.get("inferredState"):
+        header.append("state=" + _header_value(hints["inferredState"]))
+    flags = [label for key, label in HINT_FLAGS if hints.get(key)]
+    if flags:
+        header.append("flags=" + ",".join(flags))
+
+    lines = [" ".join(header)]
+    if hints.get("visibleText"):
+        texts = [_truncate(t, max_text) for t in hints["visibleText"]]
+        lines.append("text " + json.dumps(texts, ensure_ascii=False))
+    lines.extend(encode_elements(snapshot.get("elements", []), max_text))
+    return lines
+
+
+def decode_snapshot(lines: List[str]) -> Dict:
+    header = _parse_header(lines[0])
+    flags = set(header.get("flags", "").split(",")) - {""}
+    hints = {key: label in flags for key, label in HINT_FLAGS}
+    hints["inferredState"] = header.get("state")
+    hints["visibleText"] = []
+
+    body = lines[1:]
+    if body and body[0].startswith("text "):
+        hints["visibleText"] = json.loads(body[0][5:])
+        body = body[1:]
+
+    return {
+        "appName": header.get("app"),
+        "pid": int(header["pid"]) if "pid" in header else None,
+        "focusedElement": header.get("focus"),
+        "hash": header.get("hash"),
+        "hints": hints,
+        "elements": decode_elements(body),
+    }
+
+
+def encode_diff(diff: Dict, max_text: int = 80) -> List[str]:
+    lines = ["diff changed=" + ("1" if diff.get("changed") else "0")]
+    if diff.get("signals"):
+        lines.append("signals " + json.dumps(diff["signals"], ensure_ascii=False))
+    for section in ("added", "removed"):
+        if diff.get(section):
+            lines.append(f"{section}:")
+            lines.extend(encode_elements(diff[section], max_text))
+    if diff.get("modified"):
+        lines.append("modified:")
+        for change in diff["modified"]:
+            before = json.dumps(change.get("before") and _truncate(change["before"], max_text), ensure_ascii=False)
+            after = json.dumps(change.get("after") and _truncate(change["after"], max_text), ensure_ascii=False)
+            lines.append(f"~{change['id']} {change['field']} {before} -> {after}")
+    return lines
+
+
+def decode_diff(lines: List[str], summary: str = "") -> Dict:
+    diff = {"changed": lines[0].endswith("=1"), "added": [], "removed": [],
+            "modified": [], "signals": [], "summary": summary}
+    section = None
+    section_lines: Dict[str, List[str]] = {"added": [], "removed": []}
+    for line in lines[1:]:
+        if line.startswith("signals "):
+            diff["signals"] = json.loads(line[8:])
+        elif line in ("added:", "removed:", "modified:"):
+            section = line[:-1]
+        elif section == "modified":
+            element_id, field_name, rest = line[1:].split(" ", 2)
+            before, end = _read_string(rest, 0)
+            after, _ = _read_string(rest, rest.index("->", end) + 3)
+            diff["modified"].append({"id": element_id, "field": field_name, "before": before, "after": after})
+        elif section:
+            section_lines[section].append(line)
+    diff["added"] = decode_elements(section_lines["added"])
+    diff["removed"] = decode_elements(section_lines["removed"])
+    return diff
+
+
+def _is_snapshot(data) -> bool:
+    return isinstance(data, dict) and "elements" in data and "hints" in data
+
+
+def _is_diff(data) -> bool:
+    return isinstance(data, dict) and "added" in data and "modified" in data
+
+
+def encode_result(result: Dict, max_text: int = 80, max_chars: Optional[int] = None) -> str:
+    """
+    Render a ToolResult for the LLM.
+
+    Snapshots and diffs get the compact form; anything else stays JSON.
+    With max_chars, whole lines are dropped from the end (never cut mid-line)
+    and a "# truncated" line says how many were dropped.
+    """
+    data = result.get("data")
+    if _is_snapshot(data):
+        body = encode_snapshot(data, max_text)
+    elif _is_diff(data):
+        body = encode_diff(data, max_text)
+    else:
+        return json.dumps(result)
+
+    status = "ok" if result.get("success", True) else "error"
+    message = " ".join((result.get("message") or "").split())
+    lines = [f"{status} {message}"] + body
+
+    text = "\n".join(lines)
+    if max_chars and len(text) > max_chars:
+        def marker(dropped: int) -> str:
+            return f"# truncated: {dropped} more lines (use find_content)"
+
+        budget = max_chars - len(marker(len(lines))) - 1  # Widest possible marker plus its newline
+        kept, size = [], 0
+        for line in lines:
+            if size + len(line) + (1 if kept else 0) > budget:
+                break
+            size += len(line) + (1 if kept else 0)
+            kept.append(line)
+        kept.append(marker(len(lines) - len(kept)))
+        text = "\n".join(kept)
+    return text
+
+
+def decode_result(text: str) -> Dict:
+    """Inverse of encode_result (up to truncated text and dropped lines)."""
+    if text.startswith("{"):
+        return json.loads(text)
+    lines = [l for l in text.split("\n") if not l.startswith("#")]
+    status, _, message = lines[0].partition(" ")
+    body = lines[1:]
+    if body and body[0].startswith("snapshot"):
+        data = decode_snapshot(body)
+    else:
+        data = decode_diff(body, summary=message)
+    return {"success": status == "ok", "message": message, "data": data}
+
+
+# =============================================================================
+# MEASUREMENT
+# =============================================================================
+
+def approx_tokens(text: str) -> int:
+    """Token count with tiktoken if available, else a word/punctuation count."""
+    if HAS_TIKTOKEN:
+        return len(tiktoken.get_encoding("cl100k_base").encode(text))
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def sample_snapshot() -> Dict:
+    """A Safari-like snapshot with the structure AppAgent.swift produces."""
+    elements = []
+
+    def add(role, path, title=None, value=None, actions=(), enabled=True, subrole=None):
+        element = {
+            "id": f"e{len(elements)}", "role": role, "subrole": subrole,
+            "title": title, "value": value, "actions": list(actions),
+            "enabled": enabled, "path": f"{path} > {role}" if path else role,
+        }
+        elements.append(element)
+        return element["path"]
+
+    app = add("AXApplication", "", title="Safari")
+    win = add("AXWindow", app, title="Google", actions=["AXRaise"])
+    for i, name in enumerate(["Close", "Minimize", "Zoom"]):
+        add("AXButton", win, subrole=f"AX{name}Button", actions=["AXPress"])
+    tb = add("AXToolbar", win)
+    for name, enabled in [("Back", True), ("Forward", False), ("Show Sidebar", True), ("Share", True)]:
+        add("AXButton", tb, title=name, actions=["AXPress"], enabled=enabled)
+    add("AXTextField", tb, subrole="AXSearchField", value="https://www.google.com/search?q=claude+ai",
+        actions=["AXPress", "AXConfirm"])
+    tabs = add("AXTabGroup", win)
+    for title in ["Google", "GitHub - anthropics", "Claude"]:
+        add("AXRadioButton", tabs, title=title, actions=["AXPress", "AXShowMenu"])
+    scroll = add("AXScrollArea", win)
+    web = add("AXWebArea", scroll, title="claude ai - Google Search")
+    for r in range(12):
+        group = add("AXGroup", web)
+        heading = add("AXHeading", group, title=f"Result {r}: Claude - an AI assistant by Anthropic")
+        add("AXLink", heading, title=f"Claude {r}", value=f"https://example.com/results/{r}/claude",
+            actions=["AXPress", "AXShowMenu"])
+        add("AXStaticText", group, value="Claude is a next generation AI assistant built for work "
+            "and trained to be safe, accurate, and secure. " * 2)
+        for label in ["Cached", "Similar"]:
+            add("AXLink", group, title=label, actions=["AXPress"])
+    add("AXScrollBar", scroll, value="0.12", actions=["AXIncrement", "AXDecrement"])
+
+    return {
+        "timestamp": "2026-01-20T10:00:00Z", "appName": "Safari", "pid": 812,
+        "focusedElement": "e12", "elements": elements, "hash": "8821349912",
+        "hints": {
+            "hasModalDialog": False, "hasErrorIndicator": False, "hasLoadingIndicator": False,
+            "hasTextField": True, "hasEnabledButtons": True,
+            "visibleText": ["Google", "claude ai - Google Search"], "inferredState": "content_view",
+        },
+    }
+
+
+def demo():
+    """Measure the encoding against raw JSON and check the round trip."""
+    snapshot = sample_snapshot()
+    result = {"success": True, "message": f"Observed {len(snapshot['elements'])} elements. State: content_view",
+              "data": snapshot}
+
+    raw = json.dumps(result)
+    counter = "tiktoken cl100k" if HAS_TIKTOKEN else "word/punct approx"
+    print(f"Elements: {len(snapshot['elements'])}  (token counter: {counter})")
+    print(f"  {'raw JSON':22s} {len(raw):6d} chars {approx_tokens(raw):6d} tokens")
+    for label, max_text in [("compact, no truncation", 0), ("compact, max_text=80", 80)]:
+        compact = encode_result(result, max_text=max_text)
+        print(f"  {label:22s} {len(compact):6d} chars {approx_tokens(compact):6d} tokens "
+              f"({1 - approx_tokens(compact) / approx_tokens(raw):.0%} fewer)")
+
+    decoded = decode_result(compact)["data"]["elements"]
+    lossless = ("id", "role", "subrole", "path", "enabled", "actions")
+    assert all(d[k] == e[k] for d, e in zip(decoded, snapshot["elements"]) for k in lossless)
+    assert len(decoded) == len(snapshot["elements"])
+    print("  round trip: ids, roles, subroles, paths, enabled, actions preserved")
+
+    # Raw AXUIElementCopyActionNames output includes custom actions like these
+    odd = sample_snapshot()
+    odd["appName"] = "System Settings"
+    odd["hints"]["inferredState"] = "odd state=\"x\""
+    odd["elements"][6]["actions"] = ["AXPress", "Name:Copy\nTarget:0x0\nSelector:(null)", "a,b]c", "AXzoom"]
+    odd["elements"][7]["role"] = "Custom Role/x,y"
+    odd["elements"][7]["path"] = odd["elements"][7]["path"].rsplit(" > ", 1)[0] + " > Custom Role/x,y"
+    odd["elements"][8]["subrole"] = "sub/role"
+    odd_result = {"success": True, "message": "odd", "data": odd}
+    decoded = decode_result(encode_result(odd_result, max_text=0))["data"]["elements"]
+    decoded_odd = decode_result(encode_result(odd_result, max_text=0))["data"]
+    assert (decoded_odd["appName"], decoded_odd["hints"]["inferredState"]) == ("System Settings", 'odd state="x"')
+    assert all(d[k] == e[k] for d, e in zip(decoded, odd["elements"]) for k in lossless)
+    print("  round trip with multi-word app name and custom action/role names: preserved")
+
+    diff = {"changed": True, "signals": ["new modal/dialog appeared"], "summary": "UI changed: 2 added",
+            "added": list(reversed(snapshot["elements"][20:24])), "removed": [],
+            "modified": [{"id": "e12", "field": "value", "before": "old", "after": None}]}
+    diff_result = {"success": True, "message": diff["summary"], "data": diff}
+    assert decode_result(encode_result(diff_result, max_text=0))["data"] == diff
+    print("  diff round trip (no truncation): exact")
+
+    truncated = encode_result(result, max_chars=2000)
+    assert len(truncated) <= 2000 and truncated.endswith("(use find_content)")
+    print(f"  max_chars=2000: {len(truncated)} chars, ends on a whole line")
+    print("\n" + "\n".join(compact.split("\n")[:16]) + "\n...")
+
+
+if __name__ == "__main__":
+    demo()